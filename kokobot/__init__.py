@@ -1 +1 @@
-from .server import run
+from .server import run, run_sharded
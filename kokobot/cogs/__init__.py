@@ -2,3 +2,5 @@ from .util import Util
 from .roles import Roles
 from .koko import Koko
 from .random import Random
+from .stats import Stats
+from .emojis import Emojis
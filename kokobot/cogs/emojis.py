@@ -0,0 +1,245 @@
+import asyncio
+import collections
+import datetime
+import logging
+import re
+import sqlite3
+
+import discord
+from discord.ext import commands
+
+from ..storage import get_storage
+
+logger = logging.getLogger('discord.kokobot.emojis')
+
+# <:name:id> or <a:name:id> for animated emojis
+CUSTOM_EMOJI = re.compile(r'<a?:[A-Za-z0-9_]{2,32}:([0-9]{15,21})>')
+
+
+class Emojis(commands.Cog):
+    """Custom emoji usage
+
+    Counts the custom emojis of each server used in messages and reactions.
+    Uses are counted in memory by emoji, day and source, and added to the
+    database in one batch every flush_interval seconds and when the storage
+    closes, so messages never
+    write to the database by themselves. The emojis of each server are
+    kept in a table of their own, updated as emojis are added, removed or
+    renamed.
+    """
+    def __init__(self, bot):
+        # config
+        self.config = {
+            'table_name': 'emojis',
+            'counts_table_name': 'emoji_counts',
+            'flush_interval': 60,  # seconds between writing emoji counts to the database
+            'top': 20,  # emojis shown by $emojis
+        }
+
+        self.bot = bot
+        self.storage = get_storage(bot)
+        self.guild_emojis = {}  # guild id -> ids of its custom emojis
+        self.counts = collections.Counter()  # (guild id, emoji id, day, source) -> uses not written to the database yet
+        self.counts_lock = asyncio.Lock()  # so $emojis sees each use once, in memory or in the database
+        self.flush_task = None
+        self.opened = False
+        self.bot.add_listener(self.on_ready, 'on_ready')
+        self.bot.add_listener(self.on_guild_join, 'on_guild_join')
+        self.bot.add_listener(self.on_guild_remove, 'on_guild_remove')
+        self.bot.add_listener(self.on_guild_emojis_update, 'on_guild_emojis_update')
+        self.bot.add_listener(self.on_message, 'on_message')
+        self.bot.add_listener(self.on_raw_reaction_add, 'on_raw_reaction_add')
+        self.storage.add_close_hook(self.flush)
+
+    def __str__(self):
+        return 'kokobot.cogs.Emojis'
+
+    def migrations(self):
+        table = self.config['table_name']
+        counts_table = self.config['counts_table_name']
+        return [
+            (1, f'create tables "{table}" and "{counts_table}"', [
+                f'''CREATE TABLE IF NOT EXISTS {table} (
+                    id INT PRIMARY KEY,
+                    guild INT,
+                    name TEXT,
+                    animated INT,
+                    date INT,
+                    removed INT
+                )''',
+                f'CREATE INDEX IF NOT EXISTS {table}_guild ON {table} (guild)',
+                f'''CREATE TABLE IF NOT EXISTS {counts_table} (
+                    guild INT,
+                    emoji INT,
+                    day TEXT,
+                    source TEXT,
+                    count INT,
+                    PRIMARY KEY (guild, emoji, day, source)
+                )''',
+            ]),
+        ]
+
+    async def on_ready(self):
+        self.owner = self.bot.get_user(self.bot.owner_id)
+        try:
+            if not self.opened:
+                await self.storage.open()
+                await self.storage.migrate(self.config['table_name'], self.migrations())
+                self.opened = True
+            # Emojis may have changed while the bot was away
+            await asyncio.gather(*[self.sync(guild) for guild in self.bot.guilds])
+            logger.info('Synced the emojis of {} guilds'.format(len(self.bot.guilds)))
+        except sqlite3.Error as e:
+            logger.info('Database error while syncing emojis: {}'.format(e))
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_counts())
+
+    async def on_guild_join(self, guild):
+        if self.opened:
+            await self.sync(guild)
+
+    async def on_guild_remove(self, guild):
+        self.guild_emojis.pop(guild.id, None)
+
+    async def on_guild_emojis_update(self, guild, before, after):
+        if self.opened:
+            await self.sync(guild)
+
+    async def sync(self, guild):
+        """Make the emoji table match the emojis of guild, marking the ones gone as removed."""
+        self.guild_emojis[guild.id] = set(emoji.id for emoji in guild.emojis)
+        table = self.config['table_name']
+        rows = [(emoji.id, guild.id, emoji.name, int(emoji.animated), int(emoji.created_at.timestamp()))
+                for emoji in guild.emojis]
+        now = int(datetime.datetime.utcnow().timestamp())
+
+        def sync(conn):
+            conn.executemany(
+                f'''INSERT INTO {table} (id, guild, name, animated, date, removed) VALUES (?, ?, ?, ?, ?, NULL)
+                    ON CONFLICT (id) DO UPDATE SET name = excluded.name, removed = NULL''', rows)
+            ids = ','.join(str(row[0]) for row in rows)
+            conn.execute(f'UPDATE {table} SET removed = (?) WHERE guild = (?) AND removed IS NULL AND id NOT IN ({ids})',
+                         (now, guild.id))
+        try:
+            await self.storage.write(sync)
+        except sqlite3.Error as e:
+            logger.info('Database error while syncing the emojis of {}: {}'.format(guild, e))
+
+    async def on_message(self, message):
+        # Most messages have no custom emoji, skip them before scanning
+        if message.guild is None or message.author.bot or not '<' in message.content:
+            return
+        emojis = self.guild_emojis.get(message.guild.id)
+        if not emojis:
+            return
+        day = message.created_at.strftime('%Y-%m-%d')
+        for emoji_id in CUSTOM_EMOJI.findall(message.content):
+            emoji_id = int(emoji_id)
+            # Emojis of other servers can be used with Nitro, only count our own
+            if emoji_id in emojis:
+                self.counts[(message.guild.id, emoji_id, day, 'message')] += 1
+
+    async def on_raw_reaction_add(self, payload):
+        if payload.guild_id is None or payload.emoji.id is None or payload.user_id == self.bot.user.id:
+            return
+        if payload.emoji.id in self.guild_emojis.get(payload.guild_id, ()):
+            day = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+            self.counts[(payload.guild_id, payload.emoji.id, day, 'reaction')] += 1
+
+    async def flush_counts(self):
+        """Periodically add the emoji uses since the last flush to the database."""
+        while True:
+            await asyncio.sleep(self.config['flush_interval'])
+            if not self.counts or not self.opened:
+                continue
+            async with self.counts_lock:
+                await self.write_counts()
+
+    async def write_counts(self):
+        # Called with counts_lock held
+        if not self.counts or not self.opened:
+            return
+        counts, self.counts = self.counts, collections.Counter()
+        try:
+            await self.storage.executemany(
+                f'''INSERT INTO {self.config["counts_table_name"]} (guild, emoji, day, source, count)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (guild, emoji, day, source) DO UPDATE SET count = count + excluded.count''',
+                [key + (count,) for key, count in counts.items()])
+        except sqlite3.Error as e:
+            logger.info('Database error while flushing emoji counts: {}'.format(e))
+            self.counts.update(counts)
+
+    async def flush(self):
+        """Stop flushing periodically and write the emoji uses left, before the storage closes."""
+        if self.flush_task is None:
+            return
+        # A flush in progress holds the lock, let it finish instead of cancelling its write
+        async with self.counts_lock:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+            self.flush_task = None
+            await self.write_counts()
+
+    @commands.command()
+    async def emojis(self, ctx, *args):
+        """ -- Show the most used custom emojis of this server
+        Usage: $emojis [--since MM-DD-YYYY]
+        Example: $emojis --since 08-24-2020
+
+        Uses in messages and reactions are both counted, removed emojis are not shown.
+        """
+        if ctx.guild is None:
+            await ctx.send('Emojis can only be counted in a server.')
+            return
+        since = None
+        if len(args) > 0:
+            if len(args) != 2 or args[0] != '--since':
+                await ctx.send('Usage: $emojis [--since MM-DD-YYYY]')
+                return
+            try:
+                since = datetime.datetime.strptime(args[1], "%m-%d-%Y").strftime('%Y-%m-%d')
+            except ValueError:
+                await ctx.send('Invalid date, use MM-DD-YYYY.')
+                return
+
+        where = 'guild = (?)'
+        params = [ctx.guild.id]
+        if not since is None:
+            where += ' AND day >= (?)'
+            params.append(since)
+        try:
+            async with self.counts_lock:
+                rows = await self.storage.fetchall(
+                    f'''SELECT emoji, source, SUM(count) FROM {self.config["counts_table_name"]}
+                        WHERE {where} GROUP BY emoji, source''', params)
+
+                # Add the uses that aren't flushed yet
+                totals = collections.defaultdict(collections.Counter)  # emoji id -> source -> uses
+                for emoji_id, source, count in rows:
+                    totals[emoji_id][source] += count
+                for (guild_id, emoji_id, day, source), count in self.counts.items():
+                    if guild_id == ctx.guild.id and (since is None or day >= since):
+                        totals[emoji_id][source] += count
+        except sqlite3.Error as e:
+            logger.info('Database error: {}'.format(e))
+            await ctx.send('Bot error, {} pls fix!'.format(self.owner.mention))
+            return
+
+        lines = []
+        for emoji_id, sources in sorted(totals.items(), key=lambda _: -sum(_[1].values())):
+            emoji = self.bot.get_emoji(emoji_id)
+            if emoji is None:
+                continue
+            lines.append('{} `{}` ({} in messages, {} reactions)'.format(
+                emoji, sum(sources.values()), sources['message'], sources['reaction']))
+            if len(lines) == self.config['top']:
+                break
+        if len(lines) == 0:
+            await ctx.send('No custom emojis used{}.'.format('' if since is None else ' since ' + args[1]))
+            return
+        title = 'Most used emojis{}'.format('' if since is None else ' since ' + args[1])
+        await ctx.send(embed=discord.Embed(title=title, description='\n'.join(lines), colour=65280))  # Green
@@ -1,6 +1,6 @@
 import asyncio
+import collections
 import logging
-import math
 import sqlite3
 import typing
 
@@ -8,11 +8,170 @@ import discord
 from discord.ext import commands
 from discord.ext.commands.errors import MissingRequiredArgument
 
+from ..cache import LRUCache, MISSING
+from ..metrics import registry
+from ..paginator import PageSource, Paginator
+from ..reactions import get_router
+from ..scheduler import get_scheduler
+from ..sessions import get_sessions
+from ..storage import get_storage
+
 logger = logging.getLogger('discord.kokobot.koko')
-emoji_bank = {
-    ':left_arrow:': '\U00002B05',
-    ':right_arrow:': '\U000027A1',
-}
+
+
+def parse_trigger(content):
+    """Get the note name of a `*name` trigger on the last line of content, or None.
+
+    Only the last line is looked at, without splitting the whole message.
+    """
+    start = content.rfind('\n') + 1
+    if start >= len(content) or content[start] != '*':
+        return None
+    if content.find('*', start + 1) != -1:
+        return None
+    return content[start + 1:]
+
+
+class NoteListSource(PageSource):
+    """Notes (belonging to a user) ordered by name.
+
+    Pages are fetched by seeking past the last name of the page before,
+    instead of skipping over all previous notes.
+    """
+    def __init__(self, koko, user):
+        self.koko = koko
+        self.user = user
+        self.per_page = koko.config['per_page']
+        self.anchors = {0: None}  # page -> last name before it
+
+    def __str__(self):
+        return 'koko list for {}'.format(self.user)
+
+    async def count(self):
+        count = await self.koko.storage.fetchone(
+            f'SELECT notes FROM {self.koko.config["counts_table_name"]} WHERE user=(?)',
+            (0 if self.user is None else self.user.id,))
+        return 0 if count is None else count[0]
+
+    async def fetch(self, page):
+        where = '1' if self.user is None else 'user=(?)'
+        params = () if self.user is None else (self.user.id,)
+        offset = 0
+        if not page in self.anchors:
+            offset = page * self.per_page
+        elif not self.anchors[page] is None:
+            where += ' AND name > (?)'
+            params += (self.anchors[page],)
+        results = await self.koko.storage.fetchall(
+            f'SELECT name FROM {self.koko.config["table_name"]} WHERE {where} ORDER BY name LIMIT (?) OFFSET (?)',
+            params + (self.per_page, offset))
+        if results:
+            self.anchors[page + 1] = results[-1][0]
+        return [_[0] for _ in results]
+
+    def format(self, page, entries):
+        title = "List Results: Notes of "
+        if self.user is None:
+            title += f"@everyone"
+        else:
+            title += f"{self.user}"
+        desc = None
+        if entries:
+            desc = '\n'.join(['*' + _ for _ in entries])
+        return discord.Embed(title=title, description=desc, colour=2818026)  # Aqua
+
+    def state(self):
+        return {'source': 'list', 'user': None if self.user is None else self.user.id}
+
+
+class NoteSearchSource(PageSource):
+    """Notes matching a query, ranked by relevance.
+
+    Pages are fetched by seeking past the (rank, name), or the name when
+    the index can't be used, of the last result before. Ranking still has
+    to look at every match to sort them, so seeking doesn't make deep pages
+    cheaper. Results are limited to search_max_results instead.
+    """
+    def __init__(self, koko, query, notes=False):
+        self.koko = koko
+        self.query = query
+        self.notes = notes
+        self.per_page = koko.config['per_page']
+        self.max_results = koko.config['search_max_results']
+        self.match = koko.match_expression(query, notes)
+        self.anchors = {0: None}  # page -> last (rank, name) or name before it
+
+        # Substring scan for queries the index can't handle
+        pattern = '%{}%'.format(query.replace('!', '!!').replace('%', '!%').replace('_', '!_'))
+        self.where = "name LIKE (?) ESCAPE '!'"
+        self.params = (pattern,)
+        if notes:
+            self.where += " OR value LIKE (?) ESCAPE '!'"
+            self.params = (pattern, pattern)
+
+    def __str__(self):
+        return 'koko search for "{}"'.format(self.query)
+
+    async def count(self):
+        table = self.koko.config['table_name']
+        fts_table = self.koko.config['fts_table_name']
+        if self.match is None:
+            count = await self.koko.storage.fetchone(
+                f'SELECT COUNT(*) FROM {table} WHERE {self.where}', self.params)
+        else:
+            count = await self.koko.storage.fetchone(
+                f'SELECT COUNT(*) FROM {fts_table} WHERE {fts_table} MATCH (?)', (self.match,))
+        return min(count[0], self.max_results)
+
+    async def fetch(self, page):
+        if page * self.per_page >= self.max_results:
+            return []
+        anchor = self.anchors.get(page)
+        offset = 0
+        if not page in self.anchors:
+            offset = page * self.per_page
+        if self.match is None:
+            where = f'({self.where})'
+            params = self.params
+            if not anchor is None:
+                where += ' AND name > (?)'
+                params += (anchor,)
+            results = await self.koko.storage.fetchall(
+                f'''SELECT name, NULL, NULL FROM {self.koko.config["table_name"]}
+                    WHERE {where} ORDER BY name LIMIT (?) OFFSET (?)''',
+                params + (self.per_page, offset))
+        else:
+            fts_table = self.koko.config['fts_table_name']
+            snippet_tokens = self.koko.config['snippet_tokens'][self.koko.fts_tokenizer]
+            where = f'{fts_table} MATCH (?)'
+            params = (self.match,)
+            if not anchor is None:
+                where += ' AND (rank > (?) OR (rank = (?) AND name > (?)))'
+                params += (anchor[0], anchor[0], anchor[1])
+            results = await self.koko.storage.fetchall(
+                f'''SELECT name, snippet({fts_table}, 1, '**', '**', '...', {snippet_tokens}), rank
+                    FROM {fts_table} WHERE {where} ORDER BY rank, name LIMIT (?) OFFSET (?)''',
+                params + (self.per_page, offset))
+        results = results[:self.max_results - page * self.per_page]
+        if results:
+            last = results[-1]
+            self.anchors[page + 1] = last[0] if self.match is None else (last[2], last[0])
+        return results
+
+    def format(self, page, entries):
+        title = f"Search Results: Contains \"{self.query}\""
+        if self.notes:
+            title += " in names or notes"
+        desc = None
+        if entries:
+            if self.notes:
+                desc = '\n'.join(['*' + _[0] + (' -- ' + _[1] if _[1] else '') for _ in entries])
+            else:
+                desc = '\n'.join(['*' + _[0] for _ in entries])
+        return discord.Embed(title=title, description=desc, colour=16761035)  # Pink
+
+    def state(self):
+        return {'source': 'search', 'query': self.query, 'notes': self.notes}
 
 
 class Koko(commands.Cog):
@@ -26,46 +185,302 @@ class Koko(commands.Cog):
                 name TEXT UNIQUE,
                 value TEXT
             )''',
+            'counts_table_name': 'koko_counts',
+            'fts_table_name': 'koko_fts',
+            'fts_tokenizers': ['trigram', 'unicode61'],  # first one supported by sqlite is used
+            'snippet_tokens': {'trigram': 48, 'unicode61': 10},  # tokens of note shown per search result
             'per_page': 10,
+            'search_max_results': 200,  # results of a search that can be paged through
+            'cache_size': 2048,  # notes kept in memory
+            'cache_ttl': 60 * 60,  # seconds
+            'cache_negative_ttl': 5 * 60,  # seconds to remember missing notes
+            'cache_preload': 256,  # most used notes loaded into the cache at startup
+            'hits_flush_interval': 60,  # seconds between writing note hits to the database
+            'sync_interval': 5,  # seconds between checking for notes changed by other processes
         }
 
         self.bot = bot
-        self.conn = None
+        self.storage = get_storage(bot)
+        self.scheduler = get_scheduler(bot)
+        self.router = get_router(bot)
+        self.sessions = get_sessions(bot)
+        self.cache = LRUCache(maxsize=self.config['cache_size'],
+                              ttl=self.config['cache_ttl'],
+                              negative_ttl=self.config['cache_negative_ttl'])
+        registry.gauge('kokobot_note_cache', 'Note cache statistics.',
+                       lambda: {(k,): v for k, v in self.cache.stats().items()}, ('stat',))
+        self.names = None  # all known note names, None until loaded
+        self.fts_tokenizer = None
+        self.hits = collections.Counter()  # note hits not written to the database yet
+        self.hits_task = None
+        self.hits_lock = asyncio.Lock()  # so a flush on close doesn't cancel one in progress
+        self.sync_task = None
+        self.own_changes = 0  # note changes committed by this process since sync last checked
         self.messages = {}
+        self.restored = False
         self.bot.add_listener(self.on_ready, 'on_ready')
         self.bot.add_listener(self.setup, 'on_connect')
         self.bot.add_listener(self.setup, 'on_resumed')
         self.bot.add_listener(self.teardown, 'on_disconnect')
+        self.storage.add_close_hook(self.flush)
         self.bot.add_listener(self.get, 'on_message')
-        self.bot.add_listener(self.react, 'on_reaction_add')
 
     def __str__(self):
         return 'kokobot.cogs.Koko'
 
+    def migrations(self):
+        table = self.config['table_name']
+        counts_table = self.config['counts_table_name']
+        fts_table = self.config['fts_table_name']
+
+        def create_counts(conn):
+            # Notes per user, user 0 holds the count of all notes
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {counts_table} (user INT PRIMARY KEY, notes INT)')
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {counts_table}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {counts_table}(user, notes) VALUES (new.user, 1), (0, 1)
+                    ON CONFLICT(user) DO UPDATE SET notes = notes + 1;
+            END''')
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {counts_table}_delete AFTER DELETE ON {table} BEGIN
+                UPDATE {counts_table} SET notes = notes - 1 WHERE user IN (old.user, 0);
+            END''')
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {counts_table}_update AFTER UPDATE OF user ON {table} BEGIN
+                UPDATE {counts_table} SET notes = notes - 1 WHERE user = old.user;
+                INSERT INTO {counts_table}(user, notes) VALUES (new.user, 1)
+                    ON CONFLICT(user) DO UPDATE SET notes = notes + 1;
+            END''')
+            conn.execute(f'INSERT OR REPLACE INTO {counts_table} SELECT user, COUNT(*) FROM {table} GROUP BY user')
+            conn.execute(f'INSERT OR REPLACE INTO {counts_table} SELECT 0, COUNT(*) FROM {table}')
+
+        def create_search(conn, key='rowid'):
+            created = False
+            for tokenizer in self.config['fts_tokenizers']:
+                try:
+                    conn.execute(f'''CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+                        name, value, content="{table}", content_rowid="{key}", tokenize="{tokenizer}"
+                    )''')
+                    created = True
+                    break
+                except sqlite3.OperationalError as e:
+                    logger.info(f'Cannot create table "{fts_table}" using {tokenizer} tokenizer: {e}')
+            if not created:
+                # No FTS5, searches scan the notes instead
+                return
+            # Only reindex when the indexed columns change, not on hit count updates
+            for trigger in ('insert', 'delete', 'update'):
+                conn.execute(f'DROP TRIGGER IF EXISTS {fts_table}_{trigger}')
+            conn.execute(f'''CREATE TRIGGER {fts_table}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts_table}(rowid, name, value) VALUES (new.{key}, new.name, new.value);
+            END''')
+            conn.execute(f'''CREATE TRIGGER {fts_table}_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts_table}({fts_table}, rowid, name, value) VALUES ('delete', old.{key}, old.name, old.value);
+            END''')
+            conn.execute(f'''CREATE TRIGGER {fts_table}_update AFTER UPDATE OF name, value ON {table} BEGIN
+                INSERT INTO {fts_table}({fts_table}, rowid, name, value) VALUES ('delete', old.{key}, old.name, old.value);
+                INSERT INTO {fts_table}(rowid, name, value) VALUES (new.{key}, new.name, new.value);
+            END''')
+            conn.execute(f'''INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')''')
+
+        def add_id(conn):
+            # The search index points at notes by rowid, which VACUUM may
+            # renumber unless it's an INTEGER PRIMARY KEY column
+            conn.execute(f'''CREATE TABLE {table}_new (
+                id INTEGER PRIMARY KEY,
+                date INT UNIQUE,
+                user INT,
+                name TEXT UNIQUE,
+                value TEXT,
+                guild INT,
+                hits INT NOT NULL DEFAULT 0,
+                version INT NOT NULL DEFAULT 1
+            )''')
+            conn.execute(f'''INSERT INTO {table}_new (id, date, user, name, value, guild, hits, version)
+                SELECT rowid, date, user, name, value, guild, hits, version FROM {table}''')
+            conn.execute(f'DROP TABLE IF EXISTS {fts_table}')
+            conn.execute(f'DROP TABLE {table}')  # and its indexes and triggers
+            conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_user_name ON {table} (user, name)')
+            create_counts(conn)
+            create_search(conn, 'id')
+
+        return [
+            (1, f'create table "{table}"', [
+                f'CREATE TABLE IF NOT EXISTS {table} {self.config["schema"]}',
+            ]),
+            (2, f'index "{table}" by user', [
+                f'CREATE INDEX IF NOT EXISTS {table}_user_name ON {table} (user, name)',
+            ]),
+            (3, f'create table "{counts_table}"', create_counts),
+            (4, f'create table "{fts_table}"', create_search),
+            (5, f'add guild, hits and version to "{table}"', [
+                f'ALTER TABLE {table} ADD COLUMN guild INT',
+                f'ALTER TABLE {table} ADD COLUMN hits INT NOT NULL DEFAULT 0',
+                f'ALTER TABLE {table} ADD COLUMN version INT NOT NULL DEFAULT 1',
+            ]),
+            (6, f'key "{table}" and "{fts_table}" by an id column', add_id),
+            (7, f'count changes of "{table}"', [
+                # One row counting the changes of notes, for other processes to poll
+                f'CREATE TABLE IF NOT EXISTS {table}_changes (id INTEGER PRIMARY KEY CHECK (id = 0), changes INT)',
+                f'INSERT OR IGNORE INTO {table}_changes VALUES (0, 0)',
+                f'''CREATE TRIGGER IF NOT EXISTS {table}_changes_insert AFTER INSERT ON {table} BEGIN
+                    UPDATE {table}_changes SET changes = changes + 1;
+                END''',
+                f'''CREATE TRIGGER IF NOT EXISTS {table}_changes_delete AFTER DELETE ON {table} BEGIN
+                    UPDATE {table}_changes SET changes = changes + 1;
+                END''',
+                f'''CREATE TRIGGER IF NOT EXISTS {table}_changes_update AFTER UPDATE OF user, name, value ON {table} BEGIN
+                    UPDATE {table}_changes SET changes = changes + 1;
+                END''',
+            ]),
+        ]
+
     async def setup(self):
         logger.info("Beginning connection to sqlite...")
-        if not self.conn is None:
-            self.conn.close()
-        self.conn = sqlite3.connect('kokobot.db')
-
-        # Create table if it doesn't exist
-        c = self.conn.cursor()
-        c.execute(f'''SELECT name FROM sqlite_master WHERE type="table" AND name="{self.config['table_name']}"''')
-        has = c.fetchone()
+        await self.storage.open()
+        await self.storage.migrate(self.config['table_name'], self.migrations())
+
+        # Find the tokenizer used for search
+        fts_table = self.config['fts_table_name']
+        has = await self.storage.fetchone(
+            'SELECT sql FROM sqlite_master WHERE type="table" AND name=(?)', (fts_table,))
         if has is None:
-            logger.info(f'Created table "{self.config["table_name"]}"')
-            c.execute(f'''CREATE TABLE {self.config['table_name']} {self.config['schema']}''')
+            self.fts_tokenizer = None
+            logger.info(f'Table "{fts_table}" does not exist, searching without it')
         else:
-            logger.info(f'Found table "{self.config["table_name"]}"')
-        self.conn.commit()
+            self.fts_tokenizer = 'trigram' if 'trigram' in has[0] else 'unicode61'
+            logger.info(f'Found table "{fts_table}" using {self.fts_tokenizer} tokenizer')
+
+        # Load the known note names
+        rows = await self.storage.fetchall(f'SELECT name FROM {self.config["table_name"]}')
+        self.names = set(row[0] for row in rows)
+        logger.info('Loaded {} note names'.format(len(self.names)))
+
+        # Warm up the note cache with the most used notes
+        if len(self.cache) == 0:
+            rows = await self.storage.fetchall(
+                f'SELECT name, value, user FROM {self.config["table_name"]} ORDER BY hits DESC, date DESC LIMIT (?)',
+                (self.config['cache_preload'],))
+            for name, value, user in rows:
+                self.cache.put(name, (value, user))
+            logger.info('Preloaded {} notes into the cache'.format(len(rows)))
+
+        if self.hits_task is None:
+            self.hits_task = asyncio.ensure_future(self.flush_hits())
+        if self.sync_task is None:
+            self.sync_task = asyncio.ensure_future(self.sync())
+
+    async def changes(self):
+        row = await self.storage.fetchone(f'SELECT changes FROM {self.config["table_name"]}_changes')
+        return 0 if row is None else row[0]
+
+    async def sync(self):
+        """Drop the notes kept in memory when another process changes the notes.
+
+        Shards running in other processes share the database, so their
+        adds and removes are only seen through it. Notes are only reloaded
+        when the count of note changes moved by more than the changes of
+        this process, other commits like hits, sessions or stats don't
+        touch it. The data version of the database is checked first, it
+        doesn't move for commits of this process, so most polls don't read
+        anything.
+        """
+        version = await self.storage.data_version()
+        self.own_changes = 0
+        changes = await self.changes()
+        while True:
+            await asyncio.sleep(self.config['sync_interval'])
+            try:
+                new_version = await self.storage.data_version()
+                if new_version == version:
+                    continue
+                version = new_version
+                # Taken before reading, so every change counted is committed in what's read
+                own_changes, self.own_changes = self.own_changes, 0
+                new_changes = await self.changes()
+                expected, changes = changes + own_changes, new_changes
+                if new_changes == expected:
+                    continue
+                rows = await self.storage.fetchall(f'SELECT name FROM {self.config["table_name"]}')
+                self.names = set(row[0] for row in rows)
+                self.cache.clear()
+                # Changes of this process counted since are in what was just loaded
+                self.own_changes = 0
+                logger.info('Notes changed by another process, reloaded {} note names'.format(len(self.names)))
+            except sqlite3.Error as e:
+                logger.info('Database error while checking for changed notes: {}'.format(e))
+
+    async def flush_hits(self):
+        """Periodically add the hits of notes since the last flush to the database."""
+        while True:
+            await asyncio.sleep(self.config['hits_flush_interval'])
+            if not self.hits:
+                continue
+            async with self.hits_lock:
+                await self.write_hits()
+
+    async def write_hits(self):
+        # Called with hits_lock held
+        if not self.hits:
+            return
+        hits, self.hits = self.hits, collections.Counter()
+        try:
+            await self.storage.executemany(
+                f'UPDATE {self.config["table_name"]} SET hits = hits + (?) WHERE name=(?)',
+                [(count, name) for name, count in hits.items()])
+        except sqlite3.Error as e:
+            logger.info('Database error while flushing note hits: {}'.format(e))
+            self.hits.update(hits)
+
+    async def flush(self):
+        """Stop flushing hits periodically and write the hits left, before the storage closes."""
+        if self.hits_task is None:
+            return
+        async with self.hits_lock:
+            self.hits_task.cancel()
+            try:
+                await self.hits_task
+            except asyncio.CancelledError:
+                pass
+            self.hits_task = None
+            await self.write_hits()
+
+    def match_expression(self, query, notes):
+        """Get the FTS5 MATCH expression for query, or None if the index can't be used."""
+        query = query.strip()
+        if (len(query) == 0 or self.fts_tokenizer is None
+                or (self.fts_tokenizer == 'trigram' and len(query) < 3)):
+            return None
+        phrase = '"{}"'.format(query.replace('"', '""'))
+        if notes:
+            return phrase
+        return '{{name}} : {}'.format(phrase)
 
     async def teardown(self):
-        logger.info("Closing connection to sqlite...")
-        if not self.conn is None:
-            self.conn.close()
+        # The storage is shared with other cogs and stays open across
+        # reconnects, it is closed when the bot shuts down.
+        logger.info("Disconnected, keeping sqlite storage open...")
 
     async def on_ready(self):
         self.owner = self.bot.get_user(self.bot.owner_id)
+        if not self.restored:
+            self.restored = True
+            await self.restore()
+
+    async def lookup(self, name):
+        """Get (value, user) of a note through the cache, or None if it doesn't exist."""
+        if not self.names is None and not name in self.names:
+            return None
+        note = self.cache.get(name)
+        if note is MISSING:
+            return None
+        if note is None:
+            note = await self.storage.fetchone(
+                f'SELECT value, user FROM {self.config["table_name"]} WHERE name=(?) LIMIT 1', (name,))
+            if note is None:
+                self.cache.put_missing(name)
+            else:
+                note = tuple(note)
+                self.cache.put(name, note)
+        return note
 
     @commands.group()
     async def koko(self, ctx):
@@ -87,10 +502,14 @@ class Koko(commands.Cog):
         date = ctx.message.created_at.timestamp()
         user = ctx.message.author.id
         try:
-            c = self.conn.cursor()
-            c.execute(f'INSERT INTO {self.config["table_name"]} VALUES (?, ?, ?, ?)',
-                      (date, user, name, note))
-            self.conn.commit()
+            guild = None if ctx.guild is None else ctx.guild.id
+            await self.storage.submit(
+                f'INSERT INTO {self.config["table_name"]} (date, user, name, value, guild) VALUES (?, ?, ?, ?, ?)',
+                (date, user, name, note, guild))
+            self.own_changes += 1
+            self.cache.put(name, (note, user))
+            if not self.names is None:
+                self.names.add(name)
             logger.info('Added note `{}` for {}'.format(name, ctx.message.author))
             await ctx.send("Added `*{}` with note: {}".format(name, note))
         except sqlite3.IntegrityError as e:
@@ -117,13 +536,12 @@ class Koko(commands.Cog):
 
         Only 1 per message, and this command must be on the last line.
         """
-        if message.author != self.bot.user and message.author.bot:
-            return
-
         # Last line
-        lines = message.content.split('\n')
-        if len(lines) > 0 and len(lines[-1]) > 0 and lines[-1][0] == '*' and lines[-1].count('*') == 1:
-            name = lines[-1][1:]
+        name = parse_trigger(message.content)
+        if not name is None:
+            if message.author != self.bot.user and message.author.bot:
+                return
+
             if len(name) == 0:
                 sent = await message.channel.send('Empty name.')
                 await sent.delete(delay=5)
@@ -138,19 +556,16 @@ class Koko(commands.Cog):
 
             try:
                 # Get note and send it
-                c = self.conn.cursor()
-                c.execute(f'SELECT value FROM {self.config["table_name"]} WHERE name=(?) LIMIT 1', (name,))
-                note = c.fetchone()
-                self.conn.commit()
+                note = await self.lookup(name)
                 if note is None:
                     await message.channel.send('`*{}` does not exist.'.format(name))
                 else:
                     value = note[0]
+                    self.hits[name] += 1
 
                     # Store chaining from kokobot
                     chains = 1
-                    lines = value.split('\n')
-                    if len(lines) > 0 and len(lines[-1]) > 0 and lines[-1][0] == '*':
+                    if not parse_trigger(value) is None:
                         if message.author == self.bot.user:
                             chains = message.nonce + 1
 
@@ -172,21 +587,22 @@ class Koko(commands.Cog):
         Example: $koko remove/delete hello
         """
         deleter = ctx.message.author.id
-        c = self.conn.cursor()
-        c.execute(f'SELECT user FROM {self.config["table_name"]} WHERE name=(?) LIMIT 1', (name,))
-        user = c.fetchone()
-        if user is None:
+        note = await self.lookup(name)
+        if note is None:
             await ctx.send('`*{}` does not exist.'.format(name))
         else:
-            owner = user[0]
+            owner = note[1]
             if owner != deleter:
                 owner = ctx.bot.get_user(owner)
                 await ctx.send('`*{}` belongs to {}.\nCannot delete a note that\'s not your\'s, {}.'.format(name, owner, ctx.message.author.mention))
             else:
-                c.execute(f'DELETE FROM {self.config["table_name"]} WHERE name=(?)', (name,))
+                self.own_changes += await self.storage.submit(
+                    f'DELETE FROM {self.config["table_name"]} WHERE name=(?) AND user=(?)', (name, deleter))
+                self.cache.put_missing(name)
+                if not self.names is None:
+                    self.names.discard(name)
                 logger.info('Removed note `{}` for {}'.format(name, ctx.message.author))
                 await ctx.send("Removed `*{}`.".format(name))
-        self.conn.commit()
 
     @remove.error
     async def remove_error(self, ctx, error):
@@ -214,37 +630,16 @@ class Koko(commands.Cog):
     async def delete_error(self, ctx, error):
         await self.remove_error(ctx, error)
 
-    async def clear_message(self, future, message):
-        await asyncio.sleep(60)
-        if not future.cancelled():
-            # FIXME: clear reactions for DMs are unattainable because
-            # 'manage_messages' permission cannot be attained for all DMs
-            await message.clear_reactions()
-            self.messages.pop(message.id)
-
-    async def react(self, reaction, user):
-        if (user == self.bot.user
-                or not reaction.emoji in (emoji_bank[':left_arrow:'], emoji_bank[':right_arrow:'])
-                or not reaction.message.id in self.messages):
+    async def react(self, payload):
+        if not payload.message_id in self.messages:
             return
 
-        # Get new page number
-        message_id = reaction.message.id
-        page = self.messages[message_id]['page']
-        if reaction.emoji == emoji_bank[':left_arrow:']:
-            page -= 1
-            if page < 0:
-                page = 0
-        if reaction.emoji == emoji_bank[':right_arrow:']:
-            page += 1
-
-        # Reset message
-        if self.messages[message_id]['type'] == 'list':
-            await self.list_notes(self.messages[message_id]['message'], page,
-                                  self.messages[message_id]['user'])
-        elif self.messages[message_id]['type'] == 'search':
-            await self.search_notes(self.messages[message_id]['message'], page,
-                                    self.messages[message_id]['query'])
+        paginator = self.messages[payload.message_id]
+        try:
+            await paginator.react(str(payload.emoji), discord.Object(payload.user_id))
+            await self.save(paginator, later=True)
+        except Exception as e:
+            await self.report_error(paginator.message.channel, e)
 
     @koko.command()
     async def who(self, ctx, *, name):
@@ -252,14 +647,11 @@ class Koko(commands.Cog):
         Uasge: $koko who <name>
         Example: $koko who hello
         """
-        c = self.conn.cursor()
-        c.execute(f'SELECT user FROM {self.config["table_name"]} WHERE name=(?)', (name,))
-        user = c.fetchone()
-        self.conn.commit()
-        if user is None:
+        note = await self.lookup(name)
+        if note is None:
             await ctx.send("`*{}` does not exist.".format(name))
         else:
-            user = self.bot.get_user(user[0])
+            user = self.bot.get_user(note[1])
             await ctx.send("`*{}` was added by {}.".format(name, user))
 
     @who.error
@@ -276,6 +668,16 @@ class Koko(commands.Cog):
             logger.info('Python error: {}'.format(error))
             await ctx.send('Bot error, {} pls fix!'.format(self.owner.mention))
 
+    @koko.command()
+    @commands.is_owner()
+    async def cache(self, ctx):
+        """ -- Show note cache statistics (owner only)
+        Usage: $koko cache
+        """
+        stats = self.cache.stats()
+        await ctx.send('Cache: `{size}/{maxsize}` notes, `{hits}` hits, `{misses}` misses, '
+                       '`{evictions}` evictions, `{hit_rate:.1%}` hit rate.'.format(**stats))
+
     @koko.command()
     async def list(self, ctx, user: discord.User=None):
         """ -- List a set of notes (belonging to a user)
@@ -286,162 +688,74 @@ class Koko(commands.Cog):
         If user field is not empty, it needs to tag the user.
         """
         message = await ctx.send('Listing...')
-        await self.list_notes(message, 0, user)
-
-    async def list_notes(self, message, page, user):
-        # Cleanup of previous message
-        if message.id in self.messages:
-            self.messages[message.id]['future'].cancel()
-        # FIXME: clear reactions for DMs are unattainable because
-        # 'manage_messages' permission cannot be attained for all DMs
-        await message.clear_reactions()
+        await self.paginate(message, NoteListSource(self, user))
 
+    async def paginate(self, message, source, page=0):
         try:
-            # Count
-            c = self.conn.cursor()
-            if user is None:
-                c.execute(f'SELECT COUNT(*) FROM {self.config["table_name"]}')
-            else:
-                c.execute(f'SELECT COUNT(*) FROM {self.config["table_name"]} WHERE user=(?)', (user.id,))
-            count = c.fetchone()[0]
-            count = math.ceil(count / self.config['per_page'])
-            if page > count - 1:
-                page = count - 1
-
-            # Fetch Results
-            if count > 0:
-                if user is None:
-                    c.execute(f'SELECT name FROM {self.config["table_name"]} ORDER BY name LIMIT {self.config["per_page"]} OFFSET {page * self.config["per_page"]}')
-                else:
-                    c.execute(f'SELECT name FROM {self.config["table_name"]} WHERE user=(?) ORDER BY name LIMIT {self.config["per_page"]} OFFSET {page * self.config["per_page"]}', (user.id,))
-                results = c.fetchall()
-            self.conn.commit()
-
-            # Create the Embed
-            title = "List Results: Notes of "
-            if user is None:
-                title += f"@everyone"
+            paginator = Paginator(source, self.scheduler, timeout=60, on_stop=self.unpaginate)
+            if await paginator.start(message, page):
+                self.messages[message.id] = paginator
+                self.router.register(message.id, self.react)
+                await self.save(paginator)
+        except Exception as e:
+            await self.report_error(message.channel, e)
+
+    def unpaginate(self, paginator):
+        self.messages.pop(paginator.message.id, None)
+        self.router.unregister(paginator.message.id)
+        asyncio.ensure_future(self.sessions.forget(paginator.message.id))
+
+    async def save(self, paginator, later=False):
+        state = paginator.source.state()
+        state['page'] = paginator.page
+        if later:
+            # Flips are saved once they settle, not one write per reaction
+            self.sessions.save_later(paginator.message, 'koko', state)
+        else:
+            await self.sessions.save(paginator.message, 'koko', state)
+
+    async def restore(self):
+        """Pick up the paginated messages that were running before a restart."""
+        if self.names is None:
+            await self.setup()
+        restored = []
+        for message, state in await self.sessions.restore('koko'):
+            # Saved again by paginate() if it still has pages to flip
+            await self.sessions.forget(message.id)
+            if state['source'] == 'list':
+                user = None
+                if not state['user'] is None:
+                    user = self.bot.get_user(state['user']) or await self.bot.fetch_user(state['user'])
+                source = NoteListSource(self, user)
             else:
-                title += f"{user}"
-            desc = None
-            if count > 0:
-                desc = '\n'.join(['*' + _[0] for _ in results])
-            embed = discord.Embed(title=title, description=desc, colour=2818026)  # Aqua
-            actual_page = page + 1
-            if count == 0:
-                actual_page = 0
-            embed.set_footer(text=f"Page {actual_page} of {count}")
-
-            # Edit the message
-            await message.edit(content=None, embed=embed)
-            logger.info('Sent koko list page {} of {} for {}'.format(actual_page, count, user))
-
-            # React to the message
-            has_more = False
-            if actual_page > 1:
-                has_more = True
-                await message.add_reaction(emoji_bank[':left_arrow:'])
-            if actual_page < count:
-                has_more = True
-                await message.add_reaction(emoji_bank[':right_arrow:'])
-
-            if has_more:
-                # Add message to messages dict
-                self.messages[message.id] = {}
-                self.messages[message.id]['message'] = message
-                self.messages[message.id]['type'] = 'list'
-                self.messages[message.id]['user'] = user
-                self.messages[message.id]['page'] = page
-
-                # Schedule a future clear of message
-                future = asyncio.Future()
-                asyncio.ensure_future(self.clear_message(future, message))
-                self.messages[message.id]['future'] = future
-        except sqlite3.ProgrammingError as e:
+                source = NoteSearchSource(self, state['query'], state['notes'])
+            restored.append(self.paginate(message, source, state['page']))
+        await asyncio.gather(*restored)
+
+    async def report_error(self, channel, e):
+        if isinstance(e, sqlite3.ProgrammingError):
             logger.info('Database error: {}'.format(e))
-            await message.channel.send('Database closed, {} pls fix.'.format(self.owner.mention))
-        except sqlite3.Error as e:
+            await channel.send('Database closed, {} pls fix.'.format(self.owner.mention))
+        elif isinstance(e, sqlite3.Error):
             logger.info('Database error: {}'.format(e))
-            await message.channel.send('Bot error, {} pls fix!'.format(self.owner.mention))
-        except Exception as e:
+            await channel.send('Bot error, {} pls fix!'.format(self.owner.mention))
+        else:
             logger.info('Python error: {}'.format(e))
-            await message.channel.send('Bot error, {} pls fix!'.format(self.owner.mention))
+            await channel.send('Bot error, {} pls fix!'.format(self.owner.mention))
 
     @koko.command()
     async def search(self, ctx, *, query=""):
         """ -- Search for a set of notes that contains the <query>
-        Usage: $koko search <query>
+        Usage: $koko search [--notes] <query>
         Example: $koko search hello wow
+        Example: $koko search --notes hello wow
+
+        Results are ranked by relevance, only the most relevant ones are shown.
+        With --notes, also search inside the notes and show where they matched.
         """
-        query = query.replace('\"', '')
+        notes = False
+        if query.startswith('--notes'):
+            notes = True
+            query = query[len('--notes'):].strip()
         message = await ctx.send('Searching...')
-        await self.search_notes(message, 0, query)
-
-    async def search_notes(self, message, page, query):
-        # Cleanup of previous message
-        if message.id in self.messages:
-            self.messages[message.id]['future'].cancel()
-        # FIXME: clear reactions for DMs are unattainable because
-        # 'manage_messages' permission cannot be attained for all DMs
-        await message.clear_reactions()
-
-        try:
-            # Count
-            c = self.conn.cursor()
-            c.execute(f'SELECT COUNT(*) FROM {self.config["table_name"]} WHERE name LIKE "%{query}%"')
-            count = c.fetchone()[0]
-            count = math.ceil(count / self.config['per_page'])
-            if page > count - 1:
-                page = count - 1
-
-            # Fetch Results
-            if count > 0:
-                c.execute(f'SELECT name FROM {self.config["table_name"]} WHERE name LIKE "%{query}%" ORDER BY name LIMIT {self.config["per_page"]} OFFSET {page * self.config["per_page"]}')
-                results = c.fetchall()
-            self.conn.commit()
-
-            # Create the Embed
-            title = f"Search Results: Contains \"{query}\""
-            desc = None
-            if count > 0:
-                desc = '\n'.join(['*' + _[0] for _ in results])
-            embed = discord.Embed(title=title, description=desc, colour=16761035)  # Pink
-            actual_page = page + 1
-            if count == 0:
-                actual_page = 0
-            embed.set_footer(text=f"Page {actual_page} of {count}")
-
-            # Edit the message
-            await message.edit(content=None, embed=embed)
-            logger.info('Sent koko search page {} of {} for "{}"'.format(actual_page, count, query))
-
-            # React to the message
-            has_more = False
-            if actual_page > 1:
-                has_more = True
-                await message.add_reaction(emoji_bank[':left_arrow:'])
-            if actual_page < count:
-                has_more = True
-                await message.add_reaction(emoji_bank[':right_arrow:'])
-
-            if has_more:
-                # Add message to messages dict
-                self.messages[message.id] = {}
-                self.messages[message.id]['message'] = message
-                self.messages[message.id]['type'] = 'search'
-                self.messages[message.id]['query'] = query
-                self.messages[message.id]['page'] = page
-
-                # Schedule a future clear of message
-                future = asyncio.Future()
-                asyncio.ensure_future(self.clear_message(future, message))
-                self.messages[message.id]['future'] = future
-        except sqlite3.ProgrammingError as e:
-            logger.info('Database error: {}'.format(e))
-            await message.channel.send('Database closed, {} pls fix.'.format(self.owner.mention))
-        except sqlite3.Error as e:
-            logger.info('Database error: {}'.format(e))
-            await message.channel.send('Bot error, {} pls fix!'.format(self.owner.mention))
-        except Exception as e:
-            logger.info('Python error: {}'.format(e))
-            await message.channel.send('Bot error, {} pls fix!'.format(self.owner.mention))
+        await self.paginate(message, NoteSearchSource(self, query, notes))
@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import logging
 import random as rng
 import typing
@@ -7,6 +8,12 @@ import discord
 from discord.ext import commands
 from discord.ext.commands.errors import BadArgument
 
+from ..grouping import PairHistory, assign_groups
+from ..paginator import ListSource, Paginator
+from ..reactions import get_router
+from ..scheduler import get_scheduler
+from ..sessions import get_sessions
+
 logger = logging.getLogger('discord.kokobot.random')
 emoji_bank = {
     ':regional_indicator_j:': '\U0001F1EF',
@@ -18,107 +25,440 @@ emoji_bank = {
 }
 
 
+class GroupsSource(ListSource):
+    """Lines of the groups of a mixer that are too large for its own embed."""
+    def __init__(self, mixer, lines):
+        super().__init__(lines, per_page=20)
+        self.mixer = mixer
+
+    def __str__(self):
+        return 'groups of {}'.format(self.mixer)
+
+    def format(self, page, entries):
+        title = "Groups of the Random Mixer by {}".format(self.mixer.owner)
+        return discord.Embed(title=title, description="\n".join(entries), colour=self.mixer.message.embeds[0].colour)
+
+
+class MixerSession:
+    """A random mixer on a message.
+
+    A mixer goes from open to shuffled when its owner shuffles it, and from
+    open or shuffled to stopped when its owner stops it or to expired after
+    some time without activity. Shuffled mixers still track joins and leaves
+    and may be shuffled again, stopped and expired mixers ignore everything.
+
+    Groups are assigned by kokobot.grouping, keeping or avoiding the pairs
+    of people the owner asked for and pairing people who were together in
+    recent mixers of the guild less often. Groups too large for the embed
+    of the mixer are sent as a separate paginated message.
+
+    Live mixers are saved with the session store and picked up again after
+    a restart. The people in them are recounted from the reactions then,
+    and after reconnects, when reaction events may have been missed.
+    """
+    OPEN = 'open'
+    SHUFFLED = 'shuffled'
+    STOPPED = 'stopped'
+    EXPIRED = 'expired'
+
+    def __init__(self, cog, message, owner, groups):
+        self.cog = cog
+        self.message = message
+        self.owner = owner
+        self.groups = groups
+        self.state = MixerSession.OPEN
+        self.people = {}  # user id -> user
+        self.reactions = collections.Counter()  # user id -> join reactions
+        self.groups_list = None
+        self.keep = set()  # pairs of user ids to put in the same group
+        self.avoid = set()  # pairs of user ids to put in different groups
+        self.paged = False
+        self.results = None  # Paginator of the groups if paged
+        self.dirty = False
+        self.display_task = None
+        self.changed = None  # user ids that joined or left while reactions are recounted
+
+    def __str__(self):
+        return 'random mixer {} of {}'.format(self.message.id, self.owner)
+
+    @property
+    def is_live(self):
+        return self.state in (MixerSession.OPEN, MixerSession.SHUFFLED)
+
+    @property
+    def guild_id(self):
+        return None if self.message.guild is None else self.message.guild.id
+
+    def start(self):
+        self.touch()
+
+    def snapshot(self):
+        """Get the state of the mixer to save, people are left out since they're recounted."""
+        return {
+            'owner': self.owner.id,
+            'groups': self.groups,
+            'state': self.state,
+            'keep': sorted(self.keep),
+            'avoid': sorted(self.avoid),
+            'groups_list': None if self.groups_list is None else [[p.id for p in group] for group in self.groups_list],
+            'results': None if self.results is None else self.results.message.id,
+        }
+
+    async def save(self):
+        if self.is_live:
+            await self.cog.sessions.save(self.message, 'mixer', self.snapshot())
+
+    def touch(self):
+        # Expire the mixer after some time without activity
+        self.cog.scheduler.schedule(('mixer', self.message.id), self.cog.config['timeout'], self.expire)
+
+    def join(self, user_id, user):
+        if not self.is_live:
+            return
+        if not self.changed is None:
+            self.changed.add(user_id)
+        self.reactions[user_id] += 1
+        if not user_id in self.people:
+            self.people[user_id] = user
+            self.display()
+
+    def leave(self, user_id):
+        """Remove a join reaction, the user leaves once none of their reactions are left."""
+        if not self.is_live:
+            return
+        if not self.changed is None:
+            self.changed.add(user_id)
+        self.reactions[user_id] -= 1
+        if self.reactions[user_id] <= 0:
+            del self.reactions[user_id]
+            if user_id in self.people:
+                self.people.pop(user_id)
+                self.display()
+
+    def shuffle(self):
+        if not self.is_live:
+            return
+        if len(self.people) == 0:
+            self.groups_list = None
+        else:
+            history = self.cog.history(self.guild_id)
+            groups = assign_groups(self.people.keys(), self.groups, keep=self.keep, avoid=self.avoid,
+                                   history=history, time_budget=self.cog.config['grouping_time_budget'])
+            history.record(groups)
+            self.groups_list = [[self.people[i] for i in group] for group in groups]
+        self.paged = not self.fits()
+        self.state = MixerSession.SHUFFLED
+        self.display()
+
+    def fits(self):
+        """Whether the groups fit in the embed of the mixer."""
+        return self.groups_list is None or len(self.header()) + len(self.groups_text()) <= self.limit()
+
+    async def page_groups(self, message=None):
+        """Send the groups in their own paginated message if they don't fit in the mixer.
+
+        The groups are shown on message instead if one is given, to pick up
+        the message of the groups again after a restart.
+        """
+        if not self.results is None:
+            await self.results.stop()
+            self.results = None
+        if not self.paged:
+            return
+        lines = self.groups_text().splitlines()
+        if message is None:
+            message = await self.message.channel.send(embed=discord.Embed(description="Shuffling..."))
+        self.results = Paginator(GroupsSource(self, lines), self.cog.scheduler, timeout=self.cog.config['timeout'],
+                                 on_stop=self.cog.unpaginate)
+        if await self.results.start(message):
+            self.cog.results[message.id] = self.results
+            self.cog.router.register(message.id, self.cog.flip)
+
+    async def stop(self):
+        await self.finish(MixerSession.STOPPED)
+
+    async def expire(self):
+        await self.finish(MixerSession.EXPIRED)
+
+    async def finish(self, state):
+        if not self.is_live:
+            return
+        self.state = state
+        self.cog.scheduler.cancel(('mixer', self.message.id))
+        if not self.display_task is None:
+            self.display_task.cancel()
+        self.cog.messages.pop(self.message.id, None)
+        self.cog.router.unregister(self.message.id)
+        asyncio.ensure_future(self.cog.sessions.forget(self.message.id))
+        logger.info('{} is {}'.format(self, state))
+        if not self.results is None:
+            await self.results.stop()
+
+        # Show the final state along with the stop
+        await self.message.clear_reactions()
+        embed = self.message.embeds[0]
+        embed.description = self.description() + "\n\nMixer has stopped."
+        await self.message.edit(embed=embed)
+
+    def display(self):
+        """Show the current state of the mixer.
+
+        State changes are applied right away, but edits of the message are
+        coalesced into at most one every display_delay seconds. The last
+        edit always shows the latest state.
+        """
+        self.touch()
+        self.dirty = True
+        if self.display_task is None:
+            self.display_task = asyncio.ensure_future(self.display_loop())
+
+    async def display_loop(self):
+        try:
+            while self.is_live and self.dirty:
+                await asyncio.sleep(self.cog.config['display_delay'])
+                if not self.is_live:
+                    break
+                self.dirty = False
+                embed = self.message.embeds[0]
+                embed.description = self.description()
+                await self.message.edit(embed=embed)
+        except discord.HTTPException as e:
+            logger.info('Editing {} failed: {}'.format(self, e))
+        finally:
+            self.display_task = None
+
+    def limit(self):
+        # Leave room for the line added when the mixer stops
+        return self.cog.config['embed_limit'] - len("\n\nMixer has stopped.")
+
+    def header(self):
+        desc = f"React on {emoji_bank[':regional_indicator_j:']} {emoji_bank[':regional_indicator_o:']} {emoji_bank[':regional_indicator_i:']} {emoji_bank[':regional_indicator_n:']} below to join, unreact to leave.\n"
+        desc += f"Click {emoji_bank[':twisted_rightwards_arrows:']} to shuffle, {emoji_bank[':octagonal_sign:']} to stop.\n\n"
+        return desc
+
+    def groups_text(self):
+        desc = ""
+        if not self.groups_list is None:
+            for i in range(self.groups):
+                if len(self.groups_list[i]) > 0:
+                    desc += f"**Group {i+1}**\n"
+                    for p in self.groups_list[i]:
+                        desc += f"> {p}\n"
+                    desc += "\n"
+        return desc
+
+    def description(self):
+        desc = self.header()
+
+        # Groups, or where to find them
+        groups = self.groups_text()
+        if self.paged:
+            groups = "**Groups** are too large to show here, see the message below.\n"
+
+        # Add people, as many as fit along with the groups
+        if len(self.people) > 0:
+            room = self.limit() - len(desc) - len(groups)
+            people = "**People in this mixer:**\n"
+            for shown, p in enumerate(self.people.values()):
+                line = f"> {p}\n"
+                more = f"> ... and {len(self.people) - shown} more\n"
+                if len(people) + len(line) + len(more) + 1 > room:
+                    people += more
+                    break
+                people += line
+            desc += people + "\n"
+        return desc + groups
+
+    async def reconcile(self):
+        """Recount the reactions of the mixer, in case some reaction events were missed.
+
+        People who join or leave while the reactions are fetched keep what
+        their reaction events say, the recount may be from before them.
+        """
+        if not self.is_live or not self.changed is None:
+            return
+        self.changed = set()
+        try:
+            reactions = collections.Counter()
+            people = {}
+            message = await self.message.channel.fetch_message(self.message.id)
+            for reaction in message.reactions:
+                if str(reaction.emoji) in (emoji_bank[':twisted_rightwards_arrows:'], emoji_bank[':octagonal_sign:']):
+                    continue
+                async for user in reaction.users():
+                    if user != self.cog.bot.user:
+                        reactions[user.id] += 1
+                        people[user.id] = user
+            changed = self.changed
+        finally:
+            self.changed = None
+        if not self.is_live:
+            return
+        for user_id in changed:
+            reactions.pop(user_id, None)
+            people.pop(user_id, None)
+            if self.reactions[user_id] > 0:
+                reactions[user_id] = self.reactions[user_id]
+            if user_id in self.people:
+                people[user_id] = self.people[user_id]
+        self.reactions = reactions
+        if set(people) != set(self.people):
+            logger.info('Reconciled {}: {} people'.format(self, len(people)))
+            self.people = people
+            self.display()
+
+
 class Random(commands.Cog):
     def __init__(self, bot):
         # config
         self.config = {
-            'max_groups': 5,
+            'max_groups': 50,
+            'max_mixers': 500,  # live mixers across all guilds
+            'max_mixers_per_guild': 20,
+            'timeout': 60,  # seconds a mixer stays open without activity
+            'display_delay': 1.5,  # seconds to coalesce mixer edits over
+            'embed_limit': 2048,  # characters in the description of an embed
+            'grouping_time_budget': 0.02,  # seconds to improve the groups of a shuffle for
+            'history_size': 50000,  # pairs of people remembered per guild
         }
 
         self.bot = bot
+        self.scheduler = get_scheduler(bot)
+        self.router = get_router(bot)
+        self.sessions = get_sessions(bot)
+        self.restored = False
         self.owner = self.bot.get_user(self.bot.owner_id)
         rng.seed()
-        self.messages = {}
+        self.messages = {}  # message id -> MixerSession
+        self.results = {}  # message id -> Paginator of the groups of a mixer
+        self.histories = {}  # guild id -> PairHistory
         self.bot.add_listener(self.on_ready, 'on_ready')
-        self.bot.add_listener(self.react, 'on_reaction_add')
-        self.bot.add_listener(self.unreact, 'on_reaction_remove')
+        self.bot.add_listener(self.on_resumed, 'on_resumed')
+        self.bot.add_listener(self.on_shard_resumed, 'on_shard_resumed')
 
     def __str__(self):
         return 'kokobot.cogs.Random'
 
     async def on_ready(self):
         self.owner = self.bot.get_user(self.bot.owner_id)
+        if not self.restored:
+            self.restored = True
+            await self.restore()
+        else:
+            # Reconnected without resuming, reactions may have been missed
+            await self.reconcile()
+
+    async def on_resumed(self):
+        # Sharded bots resume each shard on its own, see on_shard_resumed
+        if not isinstance(self.bot, commands.AutoShardedBot):
+            await self.reconcile()
+
+    async def on_shard_resumed(self, shard_id):
+        await self.reconcile(shard_id)
+
+    async def reconcile(self, shard_id=None):
+        """Recount the people of every live mixer, or of those on a shard."""
+        mixers = [mixer for mixer in self.messages.values() if mixer.is_live and (
+            shard_id is None or (0 if mixer.message.guild is None else mixer.message.guild.shard_id) == shard_id)]
+        results = await asyncio.gather(*[mixer.reconcile() for mixer in mixers], return_exceptions=True)
+        for mixer, result in zip(mixers, results):
+            if isinstance(result, Exception):
+                logger.info('Recounting {} failed: {}'.format(mixer, result))
+
+    async def restore(self):
+        """Pick up the mixers that were running before a restart."""
+        mixers = []
+        for message, state in await self.sessions.restore('mixer'):
+            owner = self.bot.get_user(state['owner']) or await self.bot.fetch_user(state['owner'])
+            mixer = MixerSession(self, message, owner, state['groups'])
+            mixer.state = state['state']
+            mixer.keep = set(tuple(_) for _ in state['keep'])
+            mixer.avoid = set(tuple(_) for _ in state['avoid'])
+            if not state['groups_list'] is None:
+                mixer.groups_list = [[self.bot.get_user(_) for _ in group] for group in state['groups_list']]
+                mixer.groups_list = [[p for p in group if not p is None] for group in mixer.groups_list]
+            mixer.paged = not mixer.fits()
+            self.messages[message.id] = mixer
+            self.router.register(message.id, self.react, self.unreact)
+            mixers.append((mixer, state.get('results')))
+
+        async def page_groups(mixer, results_id):
+            # Flip the groups on the message they were on, or send them again
+            message = None
+            if not results_id is None:
+                try:
+                    message = await mixer.message.channel.fetch_message(results_id)
+                except discord.HTTPException:
+                    pass
+            await mixer.page_groups(message)
+
+        # Recount the people of every mixer at once
+        results = await asyncio.gather(*[mixer.reconcile() for mixer, _ in mixers], return_exceptions=True)
+        for (mixer, _), result in zip(mixers, results):
+            if isinstance(result, Exception):
+                logger.info('Recounting {} failed: {}'.format(mixer, result))
+            mixer.start()
+        paged = [(mixer, results_id) for mixer, results_id in mixers if mixer.paged]
+        results = await asyncio.gather(*[page_groups(*_) for _ in paged], return_exceptions=True)
+        for (mixer, _), result in zip(paged, results):
+            if isinstance(result, Exception):
+                logger.info('Paging the groups of {} failed: {}'.format(mixer, result))
+
+    def history(self, guild_id):
+        """Get the pairs of people who were grouped together in recent mixers of a guild."""
+        if not guild_id in self.histories:
+            self.histories[guild_id] = PairHistory(self.config['history_size'])
+        return self.histories[guild_id]
+
+    def live_mixer(self, channel, owner):
+        """Get the latest live mixer of owner in channel."""
+        for mixer in reversed(list(self.messages.values())):
+            if mixer.is_live and mixer.message.channel.id == channel.id and mixer.owner.id == owner.id:
+                return mixer
+        return None
+
+    def unpaginate(self, paginator):
+        self.results.pop(paginator.message.id, None)
+        self.router.unregister(paginator.message.id)
+
+    async def flip(self, payload):
+        if not payload.message_id in self.results:
+            return
+        await self.results[payload.message_id].react(str(payload.emoji), discord.Object(payload.user_id))
 
-    async def clear_message(self, message, future):
-        await asyncio.sleep(60)
-        if not future.cancelled():
-            if message.id in self.messages:
-                self.messages.pop(message.id)
-                await message.clear_reactions()
-                embed = message.embeds[0]
-                embed.description += "\n\nMixer has stopped."
-                await message.edit(embed=embed)
-
-    async def react(self, reaction, user):
-        if (user == self.bot.user
-                or not reaction.message.id in self.messages):
+    async def react(self, payload):
+        if not payload.message_id in self.messages:
             return
 
-        message = reaction.message
-        if reaction.emoji == emoji_bank[':twisted_rightwards_arrows:']:
+        mixer = self.messages[payload.message_id]
+        emoji = str(payload.emoji)
+        if emoji == emoji_bank[':twisted_rightwards_arrows:']:
             # Shuffle
-            await reaction.remove(user)
-            if len(self.messages[message.id]['people']) == 0:
-                self.messages[message.id]['groups_list'] = None
-            else:
-                self.messages[message.id]['groups_list'] = []
-                for _ in range(self.messages[message.id]['groups']):
-                    self.messages[message.id]['groups_list'].append([])
-                shuffle = list(self.messages[message.id]['people'])
-                rng.shuffle(shuffle)
-                for i, p in enumerate(shuffle):
-                    g = i % self.messages[message.id]['groups']
-                    self.messages[message.id]['groups_list'][g].append(p)
-            await self.mixer_display(self.messages[message.id]['message'],
-                                     self.messages[message.id]['people'],
-                                     self.messages[message.id]['groups'],
-                                     self.messages[message.id]['groups_list'])
-        elif reaction.emoji == emoji_bank[':octagonal_sign:']:
+            await mixer.message.remove_reaction(payload.emoji, discord.Object(payload.user_id))
+            if payload.user_id == mixer.owner.id:
+                mixer.shuffle()
+                await mixer.page_groups()
+                await mixer.save()
+        elif emoji == emoji_bank[':octagonal_sign:']:
             # Stop
-            await reaction.remove(user)
-            if user == self.messages[message.id]['owner']:
-                if 'future' in self.messages[message.id]:
-                    self.messages[message.id]['future'].cancel()
-                if message.id in self.messages:
-                    self.messages.pop(message.id)
-                    await message.clear_reactions()
-                    embed = message.embeds[0]
-                    embed.description += "\n\nMixer has stopped."
-                    await message.edit(embed=embed)
+            await mixer.message.remove_reaction(payload.emoji, discord.Object(payload.user_id))
+            if payload.user_id == mixer.owner.id:
+                await mixer.stop()
         else:
             # Add user
-            if not user in self.messages[message.id]['people']:
-                self.messages[message.id]['people'].add(user)
-                await self.mixer_display(self.messages[message.id]['message'],
-                                         self.messages[message.id]['people'],
-                                         self.messages[message.id]['groups'],
-                                         self.messages[message.id]['groups_list'])
-
-    async def unreact(self, reaction, user):
-        if (user == self.bot.user
-                or not reaction.message.id in self.messages):
+            user = payload.member
+            if user is None:
+                user = self.bot.get_user(payload.user_id)
+            mixer.join(payload.user_id, user)
+
+    async def unreact(self, payload):
+        if not payload.message_id in self.messages:
             return
 
-        if (reaction.emoji != emoji_bank[':twisted_rightwards_arrows:']
-                and reaction.emoji != emoji_bank[':octagonal_sign:']):
-            users = set()
-            message = reaction.message
-            for reaction in message.reactions:
-                async for user in reaction.users():
-                    if user != self.bot.user:
-                        users.add(user)
-            remove = []
-            for p in self.messages[message.id]['people']:
-                if not p in users:
-                    remove.append(p)
-            for p in remove:
-                if p in self.messages[message.id]['people']:
-                    self.messages[message.id]['people'].remove(p)
-            if remove:
-                await self.mixer_display(self.messages[message.id]['message'],
-                                         self.messages[message.id]['people'],
-                                         self.messages[message.id]['groups'],
-                                         self.messages[message.id]['groups_list'])
+        emoji = str(payload.emoji)
+        if (emoji != emoji_bank[':twisted_rightwards_arrows:']
+                and emoji != emoji_bank[':octagonal_sign:']):
+            self.messages[payload.message_id].leave(payload.user_id)
 
     @commands.group()
     async def random(self, ctx):
@@ -137,6 +477,7 @@ class Random(commands.Cog):
 
         By default, mix into 2 groups.
         Only the owner of the mixer may shuffle and stop the mixer.
+        Use $random keep and $random avoid to keep people together or apart.
         """
         if groups < 2:
             await ctx.send('Invalid number of groups to mix.')
@@ -146,6 +487,12 @@ class Random(commands.Cog):
             await ctx.send('Cannot mix more than {} groups.'.format(self.config['max_groups']))
             return
 
+        guild_id = None if ctx.guild is None else ctx.guild.id
+        if (len(self.messages) >= self.config['max_mixers']
+                or len([_ for _ in self.messages.values() if _.guild_id == guild_id]) >= self.config['max_mixers_per_guild']):
+            await ctx.send('Too many mixers are running, stop one or try again later.')
+            return
+
         # Create the embed
         title = f"Random Mixer for {groups} Groups"
         r = rng.randint(0, 255)
@@ -165,51 +512,70 @@ class Random(commands.Cog):
         await message.add_reaction(emoji_bank[':octagonal_sign:'])
 
         # Add to messages
-        self.messages[message.id] = {}
-        self.messages[message.id]['message'] = message
-        self.messages[message.id]['people'] = set()
-        self.messages[message.id]['groups'] = groups
-        self.messages[message.id]['groups_list'] = None
-        self.messages[message.id]['owner'] = ctx.message.author
+        mixer = MixerSession(self, message, ctx.message.author, groups)
+        self.messages[message.id] = mixer
+        self.router.register(message.id, self.react, self.unreact)
         logger.info("Created a random mixer for {}".format(ctx.message.author))
 
-        # Display and enqueue future
-        await self.mixer_display(self.messages[message.id]['message'],
-                                 self.messages[message.id]['people'],
-                                 self.messages[message.id]['groups'],
-                                 self.messages[message.id]['groups_list'])
+        # Display right away, later changes are coalesced
+        embed.description = mixer.description()
+        await message.edit(embed=embed)
+        mixer.start()
+        await mixer.save()
 
-    async def mixer_display(self, message, people, groups, groups_list):
-        if 'future' in self.messages[message.id]:
-            self.messages[message.id]['future'].cancel()
+    async def constrain(self, ctx, users, pairs, others, verb):
+        mixer = self.live_mixer(ctx.channel, ctx.message.author)
+        if mixer is None:
+            await ctx.send('You have no running mixer in this channel.')
+            return
+        ids = sorted(set(u.id for u in users))
+        if len(ids) < 2:
+            await ctx.send('Mention at least 2 different people.')
+            return
 
-        embed = message.embeds[0]
-        desc = f"React on {emoji_bank[':regional_indicator_j:']} {emoji_bank[':regional_indicator_o:']} {emoji_bank[':regional_indicator_i:']} {emoji_bank[':regional_indicator_n:']} below to join, unreact to leave.\n"
-        desc += f"Click {emoji_bank[':twisted_rightwards_arrows:']} to shuffle, {emoji_bank[':octagonal_sign:']} to stop.\n\n"
+        for i, a in enumerate(ids):
+            for b in ids[i + 1:]:
+                getattr(mixer, pairs).add((a, b))
+                getattr(mixer, others).discard((a, b))
+        mixer.touch()
+        await mixer.save()
+        await ctx.send('Will {} {} on the next shuffle.'.format(verb, ', '.join(str(u) for u in users)))
 
-        # Add people
-        if len(people) > 0:
-            desc += "**People in this mixer:**\n"
-            for p in people:
-                desc += f"> {p}\n"
-            desc += "\n"
-
-        # Groups
-        if not groups_list is None:
-            for i in range(groups):
-                if len(groups_list[i]) > 0:
-                    desc += f"**Group {i+1}**\n"
-                    for p in groups_list[i]:
-                        desc += f"> {p}\n"
-                    desc += "\n"
+    @random.command()
+    async def keep(self, ctx, *users: discord.User):
+        """ -- Keep people together in your mixer
+        Usage: $random keep <@user> <@user> [@user...]
+        Example: $random keep @Koko @Kokobot
 
-        embed.description = desc
-        await message.edit(embed=embed)
+        Applies to your latest running mixer in this channel.
+        """
+        await self.constrain(ctx, users, 'keep', 'avoid', 'keep together')
+
+    @keep.error
+    async def keep_error(self, ctx, error):
+        if isinstance(error, BadArgument):
+            await ctx.send('Invalid arguments for `$random keep`. Use `$help random keep` for more information.')
+        else:
+            logger.info('Random keep got system error: {}'.format(error))
+            await ctx.send('Bot error, {} pls fix!'.format(self.owner.mention))
 
-        future = asyncio.Future()
-        self.messages[message.id]['future'] = future
-        await self.clear_message(self.messages[message.id]['message'],
-                                 future)
+    @random.command()
+    async def avoid(self, ctx, *users: discord.User):
+        """ -- Keep people apart in your mixer
+        Usage: $random avoid <@user> <@user> [@user...]
+        Example: $random avoid @Koko @Kokobot
+
+        Applies to your latest running mixer in this channel.
+        """
+        await self.constrain(ctx, users, 'avoid', 'keep', 'keep apart')
+
+    @avoid.error
+    async def avoid_error(self, ctx, error):
+        if isinstance(error, BadArgument):
+            await ctx.send('Invalid arguments for `$random avoid`. Use `$help random avoid` for more information.')
+        else:
+            logger.info('Random avoid got system error: {}'.format(error))
+            await ctx.send('Bot error, {} pls fix!'.format(self.owner.mention))
 
     @random.command()
     async def number(self, ctx, from_num: int=0, to_num: int=100):
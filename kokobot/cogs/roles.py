@@ -1,9 +1,16 @@
 import asyncio
+import datetime
+import functools
 import logging
+import re
 
 import discord
 from discord.ext import commands
 
+from ..reactions import get_router
+from ..scheduler import get_scheduler
+from ..storage import get_storage
+
 logger = logging.getLogger('discord.kokobot.roles')
 emoji_bank = {
     ':woozy_face:': '\U0001F974',
@@ -27,6 +34,100 @@ emoji_bank = {
 }
 
 
+class RoleMatcher:
+    """Finds which of some patterns a role name contains, in one regex search.
+
+    Patterns are plain substrings. When a name contains several of them,
+    the one given first wins.
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.order = {}  # pattern -> position of its first occurrence
+        for i, pattern in enumerate(self.patterns):
+            self.order.setdefault(pattern, i)
+        self.regex = None
+        if self.patterns:
+            # Lookahead so matches overlapping each other are all found
+            self.regex = re.compile('(?=({}))'.format('|'.join(re.escape(_) for _ in self.patterns)))
+
+    def match(self, name):
+        """Get the first pattern contained in name, or None."""
+        if self.regex is None:
+            return None
+        found = [self.order[m.group(1)] for m in self.regex.finditer(name)]
+        if not found:
+            return None
+        return self.patterns[min(found)]
+
+
+class RoleBatcher:
+    """Applies the role changes of a member in a single request.
+
+    Changes are gathered per member until delay seconds pass without
+    another one, then the net result is applied with one member.edit()
+    and reported once in the channel of the last change. A role added and
+    removed again within the window is not touched at all.
+    """
+    def __init__(self, scheduler, delay=2):
+        self.scheduler = scheduler
+        self.delay = delay
+        self.pending = {}  # (guild id, member id) -> pending changes
+
+    def __len__(self):
+        return len(self.pending)
+
+    def change(self, member, role, add, channel, notify=False):
+        """Add or remove role for member, notify also reports success in channel."""
+        key = (member.guild.id, member.id)
+        if not key in self.pending:
+            self.pending[key] = {'member': member, 'roles': {}, 'notify': False}
+        batch = self.pending[key]
+        batch['roles'][role.id] = (role, add)
+        batch['member'] = member
+        batch['channel'] = channel
+        batch['notify'] = batch['notify'] or notify
+        self.scheduler.schedule(('roles-member',) + key, self.delay, functools.partial(self.apply, key))
+
+    async def apply(self, key):
+        batch = self.pending.pop(key, None)
+        if batch is None:
+            return
+        member = batch['member']
+        member = member.guild.get_member(member.id) or member
+        channel = batch['channel']
+
+        # Net changes against the roles the member has now
+        roles = {role.id: role for role in member.roles if not role.is_default()}
+        added = []
+        removed = []
+        for role, add in batch['roles'].values():
+            if add and not role.id in roles:
+                roles[role.id] = role
+                added.append(role)
+            elif not add and role.id in roles:
+                del roles[role.id]
+                removed.append(role)
+        if not added and not removed:
+            return
+
+        changes = []
+        if added:
+            changes.append('added {}'.format(', '.join('"{}"'.format(_.name) for _ in added)))
+        if removed:
+            changes.append('removed {}'.format(', '.join('"{}"'.format(_.name) for _ in removed)))
+        changes = ' and '.join(changes)
+        try:
+            await member.edit(roles=list(roles.values()), reason='kokobot role menus for {}'.format(member))
+            log = '{} role for {}.'.format(changes[0].upper() + changes[1:], member)
+            logger.info(log)
+            if batch['notify']:
+                sent = await channel.send(log)
+                await sent.delete(delay=5)
+        except discord.errors.Forbidden:
+            sent = await channel.send('Not enough permissions to have {} role for {}. (Check role hierarchy)'.format(changes, member))
+            await sent.delete(delay=5)
+
+
 class Roles(commands.Cog):
     """Modifies the member roles in this server. Check out #\U0001F440-roles channel.
 
@@ -62,6 +163,12 @@ class Roles(commands.Cog):
                 'Officers', 'Removal', 'MEE6', 'Kulture Korner',
                 'OG Server Creator :)', 'Old officers', 'Server Booster',
             ],
+            'reconcile_delay': 5,  # seconds without role events before updating the role messages
+            'role_change_delay': 2,  # seconds to gather the role changes of a member over
+            'sweep_interval': 60 * 60,  # seconds between sweeping the roles channels
+            'bulk_delete_age': 13 * 24 * 60 * 60,  # seconds, Discord only bulk deletes messages under 14 days old
+            'sweeps_table_name': 'roles_sweeps',
+            'tracked_table_name': 'roles_tracked',
         }
         self.config['invalid_roles'].extend(self.config['emoji_roles'])
         self.config['invalid_roles'].extend(self.config['year_roles'])
@@ -77,20 +184,53 @@ class Roles(commands.Cog):
 
         # Initialize
         self.bot = bot
+        self.scheduler = get_scheduler(bot)
+        self.storage = get_storage(bot)
         self.hello_ids = []
-        self.emoji_roles_bot = EmojiRoles(bot, self.config, 'emoji_roles', emoji_role_message)
-        self.year_roles_bot = EmojiRoles(bot, self.config, 'year_roles', year_role_message)
-        self.gender_roles_bot = EmojiRoles(bot, self.config, 'gender_roles', gender_role_message)
-        self.eweek_roles_bot = EmojiRoles(bot, self.config, 'eweek_roles', eweek_role_message)
-        self.text_roles_bot = TextRoles(bot, self.config)
+        self.guild_to_channel = {}
+        self.started = False
+        self.batcher = RoleBatcher(self.scheduler, self.config['role_change_delay'])
+        self.emoji_roles_bot = EmojiRoles(bot, self.config, self.batcher, 'emoji_roles', emoji_role_message)
+        self.year_roles_bot = EmojiRoles(bot, self.config, self.batcher, 'year_roles', year_role_message)
+        self.gender_roles_bot = EmojiRoles(bot, self.config, self.batcher, 'gender_roles', gender_role_message)
+        self.eweek_roles_bot = EmojiRoles(bot, self.config, self.batcher, 'eweek_roles', eweek_role_message)
+        self.text_roles_bot = TextRoles(bot, self.config, self.batcher)
         self.bot.add_cog(self.emoji_roles_bot)
         self.bot.add_cog(self.text_roles_bot)
+        self.role_bots = [self.emoji_roles_bot, self.year_roles_bot, self.gender_roles_bot,
+                          self.eweek_roles_bot, self.text_roles_bot]
         self.bot.add_listener(self.on_ready)
+        self.bot.add_listener(self.on_role_create, 'on_guild_role_create')
+        self.bot.add_listener(self.on_role_delete, 'on_guild_role_delete')
+        self.bot.add_listener(self.on_role_update, 'on_guild_role_update')
 
     def __str__(self):
         return 'kokobot.cogs.Roles'
 
+    def migrations(self):
+        sweeps_table = self.config['sweeps_table_name']
+        tracked_table = self.config['tracked_table_name']
+        return [
+            (1, f'create tables "{sweeps_table}" and "{tracked_table}"', [
+                # Last message swept per channel
+                f'CREATE TABLE IF NOT EXISTS {sweeps_table} (channel INT PRIMARY KEY, message INT)',
+                # Messages the bot keeps in the channels, deleted on the next start
+                f'CREATE TABLE IF NOT EXISTS {tracked_table} (channel INT, message INT PRIMARY KEY)',
+            ]),
+            (2, f'add menu to "{tracked_table}"', [
+                # Which message it is, so it can be reused instead of sent again
+                f'ALTER TABLE {tracked_table} ADD COLUMN menu TEXT',
+            ]),
+        ]
+
     async def on_ready(self):
+        if self.started:
+            # Reconnected, role events may have been missed meanwhile
+            for channel in self.channels:
+                self.mark_dirty(channel.guild)
+            return
+        self.started = True
+
         # Search channels
         self.channels = []
         for guild in self.bot.guilds:
@@ -98,214 +238,303 @@ class Roles(commands.Cog):
                 if self.config['channel'] in channel.name:
                     logger.info('Found channel: %s #%s' % (guild.name, channel.name))
                     self.channels.append(channel)
+                    self.guild_to_channel[guild.id] = channel
                     break
 
-        # Clean channels
-        for channel in self.channels:
-            await channel.purge(limit=None)
+        # Ready every channel at once
+        await self.storage.open()
+        await self.storage.migrate('roles', self.migrations())
+        results = await asyncio.gather(*[self.start_channel(_) for _ in self.channels], return_exceptions=True)
+        for channel, result in zip(self.channels, results):
+            if isinstance(result, Exception):
+                logger.info('Readying #{} of {} failed: {}'.format(channel.name, channel.guild.name, result))
+
+        # Clear chat
+        await self.clear()
+
+    async def start_channel(self, channel):
+        """Ready the messages of a roles channel, reusing the ones from before a restart."""
+        tracked_table = self.config['tracked_table_name']
+        rows = await self.storage.fetchall(
+            f'SELECT message, menu FROM {tracked_table} WHERE channel = (?)', (channel.id,))
+        old = {}  # menu -> message
+        for message_id, menu in rows:
+            try:
+                message = await channel.fetch_message(message_id)
+            except discord.NotFound:
+                continue
+            if menu is None or menu in old:
+                await message.delete()
+            else:
+                old[menu] = message
 
         # Add hello message
-        for channel in self.channels:
-            hello_id = await channel.send('Hello! :smiling_face_with_3_hearts:')
-            self.hello_ids.append(hello_id)
+        hello = old.pop('hello', None)
+        if hello is None:
+            hello = await channel.send('Hello! :smiling_face_with_3_hearts:')
+        self.hello_ids.append(hello)
 
         # Ready other role bots
-        await self.emoji_roles_bot.on_ready(self.channels)
-        await self.year_roles_bot.on_ready(self.channels)
-        await self.gender_roles_bot.on_ready(self.channels)
-        await self.eweek_roles_bot.on_ready(self.channels)
-        await self.text_roles_bot.on_ready(self.channels)
+        for role_bot in self.role_bots:
+            await role_bot.add_channel(channel, old.pop(role_bot.name, None))
+        for message in old.values():
+            await message.delete()
+        await self.save_tracked(channel)
 
-        # Clear chat
-        await self.clear()
+        # Clean what was sent while the bot was away
+        await self.sweep(channel)
+        logger.info('Readied #{} of {} with {} old messages'.format(channel.name, channel.guild.name, len(rows)))
+
+    async def on_role_create(self, role):
+        logger.info('Server created role "{}".'.format(role.name))
+        self.mark_dirty(role.guild)
+
+    async def on_role_delete(self, role):
+        logger.info('Server deleted role "{}".'.format(role.name))
+        self.mark_dirty(role.guild)
+
+    async def on_role_update(self, before, after):
+        logger.info('Server updated role "{}".'.format(after.name))
+        self.mark_dirty(after.guild)
+
+    def mark_dirty(self, guild):
+        """Update the role messages of guild once its roles stop changing.
+
+        Role events come in bursts when roles are reordered or renamed, each
+        event pushes the update back by reconcile_delay seconds so the whole
+        burst is handled by one reconcile().
+        """
+        if guild.id in self.guild_to_channel:
+            self.scheduler.schedule(('roles', guild.id), self.config['reconcile_delay'],
+                                    functools.partial(self.reconcile, guild.id))
+
+    async def reconcile(self, guild_id):
+        channel = self.guild_to_channel.get(guild_id)
+        if channel is None:
+            return
+        logger.info('Updating role messages of {}.'.format(channel.guild.name))
+        for role_bot in self.role_bots:
+            # Menus that aren't set up yet will see the new roles when they are
+            if channel.id in role_bot.channel_info:
+                await role_bot.setup_roles(channel)
+
+    def tracked_ids(self):
+        """Get the ids of the messages the bot keeps in the roles channels."""
+        message_ids = set(hello.id for hello in self.hello_ids if not hello is None)
+        for role_bot in self.role_bots:
+            for info in role_bot.channel_info.values():
+                if not info.get('message') is None:
+                    message_ids.add(info['message'].id)
+        return message_ids
+
+    async def save_tracked(self, channel):
+        tracked_table = self.config['tracked_table_name']
+        messages = [(_.id, 'hello') for _ in self.hello_ids if _.channel.id == channel.id]
+        for role_bot in self.role_bots:
+            info = role_bot.channel_info.get(channel.id, {})
+            if not info.get('message') is None:
+                messages.append((info['message'].id, role_bot.name))
+
+        def save(conn):
+            conn.execute(f'DELETE FROM {tracked_table} WHERE channel = (?)', (channel.id,))
+            conn.executemany(f'INSERT OR REPLACE INTO {tracked_table} (channel, message, menu) VALUES (?, ?, ?)',
+                             [(channel.id, message_id, menu) for message_id, menu in messages])
+        await self.storage.write(save)
+
+    async def sweep(self, channel):
+        """Delete the messages that aren't kept by the bot, sent since the last sweep.
+
+        Only messages after the checkpoint of the channel are read, messages
+        younger than bulk_delete_age are deleted 100 at a time and older
+        ones one by one.
+        """
+        sweeps_table = self.config['sweeps_table_name']
+        row = await self.storage.fetchone(f'SELECT message FROM {sweeps_table} WHERE channel = (?)', (channel.id,))
+        after = None if row is None else discord.Object(row[0])
+        keep = self.tracked_ids()
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.config['bulk_delete_age'])
+
+        last = None
+        recent = []
+        old = []
+        async for message in channel.history(limit=None, after=after, oldest_first=True):
+            last = message.id
+            if message.id in keep:
+                continue
+            if message.created_at > cutoff:
+                recent.append(message)
+            else:
+                old.append(message)
+
+        for i in range(0, len(recent), 100):
+            try:
+                await channel.delete_messages(recent[i:i + 100])
+            except discord.NotFound:
+                # Some were deleted already, like role commands deleted after a delay
+                for message in recent[i:i + 100]:
+                    try:
+                        await message.delete()
+                    except discord.NotFound:
+                        pass
+        for message in old:
+            try:
+                await message.delete()
+            except discord.NotFound:
+                pass
+        if not last is None:
+            await self.storage.execute(f'INSERT OR REPLACE INTO {sweeps_table} VALUES (?, ?)', (channel.id, last))
+        logger.info('Swept {} messages in #{}'.format(len(recent) + len(old), channel.name))
 
     async def clear(self):
         while True:
-            await asyncio.sleep(60 * 60) # every 60 minutes
-            message_ids = []
-            for hello_id in self.hello_ids:
-                if not hello_id is None:
-                    message_ids.append(hello_id)
-            for channel in self.emoji_roles_bot.channel_info:
-                if ('message' in self.emoji_roles_bot.channel_info[channel]
-                        and not self.emoji_roles_bot.channel_info[channel]['message'] is None):
-                    message_ids.append(self.emoji_roles_bot.channel_info[channel]['message'].id)
-            for channel in self.year_roles_bot.channel_info:
-                if ('message' in self.year_roles_bot.channel_info[channel]
-                        and not self.year_roles_bot.channel_info[channel]['message'] is None):
-                    message_ids.append(self.year_roles_bot.channel_info[channel]['message'].id)
-            for channel in self.gender_roles_bot.channel_info:
-                if ('message' in self.gender_roles_bot.channel_info[channel]
-                        and not self.gender_roles_bot.channel_info[channel]['message'] is None):
-                    message_ids.append(self.gender_roles_bot.channel_info[channel]['message'].id)
-            for channel in self.eweek_roles_bot.channel_info:
-                if ('message' in self.eweek_roles_bot.channel_info[channel]
-                        and not self.eweek_roles_bot.channel_info[channel]['message'] is None):
-                    message_ids.append(self.eweek_roles_bot.channel_info[channel]['message'].id)
-            for channel in self.text_roles_bot.channel_info:
-                if ('message' in self.text_roles_bot.channel_info[channel]
-                        and not self.text_roles_bot.channel_info[channel]['message'] is None):
-                    message_ids.append(self.text_roles_bot.channel_info[channel]['message'].id)
-            def is_role_msg(message):
-                return not message.id in message_ids
+            await asyncio.sleep(self.config['sweep_interval'])
             for channel in self.channels:
-                await channel.purge(limit=None, check=is_role_msg)
+                try:
+                    await self.sweep(channel)
+                    await self.save_tracked(channel)
+                except discord.HTTPException as e:
+                    logger.info('Sweeping #{} failed: {}'.format(channel.name, e))
 
 
 class EmojiRoles(commands.Cog):
-    def __init__(self, bot, config, roles_name, head_message):
+    def __init__(self, bot, config, batcher, roles_name, head_message):
         self.bot = bot
         self.config = config
+        self.batcher = batcher
+        self.name = roles_name
         self.roles_name = roles_name
         self.head_message = head_message
         self.channels = {}
         self.guild_to_channel = {}
         self.channel_info = {}
-        self.bot.add_listener(self.add_role, 'on_reaction_add')
-        self.bot.add_listener(self.remove_role, 'on_reaction_remove')
-        self.bot.add_listener(self.redo_roles_on_create, 'on_guild_role_create')
-        self.bot.add_listener(self.redo_roles_on_delete, 'on_guild_role_delete')
-        self.bot.add_listener(self.redo_roles_on_update, 'on_guild_role_update')
-
-    async def on_ready(self, channels):
-        for channel in channels:
-            self.channels[channel.id] = channel
-            self.guild_to_channel[channel.guild.id] = channel
-            self.channel_info[channel.id] = {}
-            await self.setup_roles(channel)
+        self.matcher = RoleMatcher(self.config[self.roles_name])
+        self.router = get_router(bot)
+
+    async def add_channel(self, channel, message=None):
+        """Set up the role message of channel, reusing message if it's given."""
+        self.channels[channel.id] = channel
+        self.guild_to_channel[channel.guild.id] = channel
+        self.channel_info[channel.id] = {}
+        if not message is None:
+            self.channel_info[channel.id]['message'] = message
+            # The roles the message was reacted with so far
+            self.channel_info[channel.id]['roles'] = {str(_.emoji): None for _ in message.reactions if _.me}
+            self.router.register(message.id, self.add_role, self.remove_role)
+        await self.setup_roles(channel)
 
     async def setup_roles(self, channel):
-        if 'message' in self.channel_info[channel.id]:
-            if not self.channel_info[channel.id]['message'] is None:
-                await self.channel_info[channel.id]['message'].delete()
-            self.channel_info[channel.id]['message'] = None
+        """Bring the role message of channel up to date with the roles of the guild.
+
+        The message is only sent the first time, after that it is kept and
+        just the reactions of roles that appeared or disappeared change.
+        """
+        info = self.channel_info[channel.id]
+        old_roles = info.get('roles', {})
+        message = info.get('message')
 
         # Setup roles
-        self.channel_info[channel.id]['roles'] = {}
+        info['roles'] = {}
         for role in channel.guild.roles:
-            for emoji_role, emoji in self.config[self.roles_name].items():
-                if emoji_role in role.name:
-                    self.channel_info[channel.id]['roles'][emoji] = role
-                    break
-
-        if self.channel_info[channel.id]['roles']:
-            # Send help string
-            help_str = self.head_message
-            for emoji_role, emoji in self.config[self.roles_name].items():
-                help_str += f'{emoji} {emoji_role}\n'
-            self.channel_info[channel.id]['message'] = await channel.send(help_str)
-
-            # React to the message
-            for emoji in self.config[self.roles_name].values():
-                if emoji in self.channel_info[channel.id]['roles']:
-                    await self.channel_info[channel.id]['message'].add_reaction(emoji)
-
-    async def redo_roles_on_create(self, role):
-        logger.info('Server created role "{}".'.format(role.name))
-        await self.setup_roles(self.guild_to_channel[role.guild.id])
-
-    async def redo_roles_on_delete(self, role):
-        logger.info('Server deleted role "{}".'.format(role.name))
-        await self.setup_roles(self.guild_to_channel[role.guild.id])
-
-    async def redo_roles_on_update(self, before, after):
-        logger.info('Server updated role "{}".'.format(after.name))
-        await self.setup_roles(self.guild_to_channel[after.guild.id])
+            emoji_role = self.matcher.match(role.name)
+            if not emoji_role is None:
+                info['roles'][self.config[self.roles_name][emoji_role]] = role
+
+        if not info['roles']:
+            if not message is None:
+                self.router.unregister(message.id)
+                await message.delete()
+            info['message'] = None
+            return
 
-    async def add_role(self, reaction, user):
-        if (user == self.bot.user
-                or not reaction.message.channel.id in self.channel_info
-                or reaction.message.id != self.channel_info[reaction.message.channel.id]['message'].id):
+        # Send help string
+        help_str = self.head_message
+        for emoji_role, emoji in self.config[self.roles_name].items():
+            help_str += f'{emoji} {emoji_role}\n'
+        # Discord strips the content it stores, compare with what it keeps
+        help_str = help_str.strip()
+        if message is None:
+            info['message'] = await channel.send(help_str)
+            self.router.register(info['message'].id, self.add_role, self.remove_role)
+            old_roles = {}
+        elif message.content != help_str:
+            await message.edit(content=help_str)
+
+        # React to the message, only for the roles that changed
+        for emoji in self.config[self.roles_name].values():
+            if emoji in info['roles'] and not emoji in old_roles:
+                await info['message'].add_reaction(emoji)
+            elif not emoji in info['roles'] and emoji in old_roles:
+                await info['message'].clear_reaction(emoji)
+
+    async def add_role(self, payload):
+        if not payload.channel_id in self.channel_info:
             return
+        channel = self.channels[payload.channel_id]
+        user = payload.member
 
         # Add the family role
-        if reaction.emoji in self.channel_info[reaction.message.channel.id]['roles']:
-            role = self.channel_info[reaction.message.channel.id]['roles'][reaction.emoji]
-            try:
-                await user.add_roles(
-                    role,
-                    reason='kokobot reaction {} from {}'.format(reaction.message.id, user))
-                logger.info('Added "{}" role for {}.'.format(role.name, user))
-            except discord.errors.Forbidden:
-                sent = await reaction.message.channel.send('Not enough permissions to add "{}" role for {}. (Check role hierarchy)'.format(role.name, user))
-                await sent.delete(delay=5)
+        if not user is None and str(payload.emoji) in self.channel_info[channel.id]['roles']:
+            role = self.channel_info[channel.id]['roles'][str(payload.emoji)]
+            self.batcher.change(user, role, True, channel)
 
-    async def remove_role(self, reaction, user):
-        if (user == self.bot.user
-                or not reaction.message.channel.id in self.channel_info
-                or reaction.message.id != self.channel_info[reaction.message.channel.id]['message'].id):
+    async def remove_role(self, payload):
+        if not payload.channel_id in self.channel_info:
             return
+        channel = self.channels[payload.channel_id]
+        # Removal events don't carry the member
+        user = channel.guild.get_member(payload.user_id)
 
-        # Add the family role
-        if reaction.emoji in self.channel_info[reaction.message.channel.id]['roles']:
-            role = self.channel_info[reaction.message.channel.id]['roles'][reaction.emoji]
-            try:
-                await user.remove_roles(
-                    role,
-                    reason='kokobot reaction {} from {}'.format(reaction.message.id, user))
-                logger.info('Removed "{}" role for {}.'.format(role.name, user))
-            except discord.errors.Forbidden:
-                sent = await reaction.message.channel.send('Not enough permissions to remove "{}" role for {}. (Check role hierarchy)'.format(role.name, user))
-                await sent.delete(delay=5)
+        # Remove the family role
+        if not user is None and str(payload.emoji) in self.channel_info[channel.id]['roles']:
+            role = self.channel_info[channel.id]['roles'][str(payload.emoji)]
+            self.batcher.change(user, role, False, channel)
 
 
 class TextRoles(commands.Cog):
-    def __init__(self, bot, config):
+    def __init__(self, bot, config, batcher):
         self.bot = bot
         self.config = config
+        self.batcher = batcher
+        self.name = 'text_roles'
         self.channels = {}
         self.guild_to_channel = {}
         self.channel_info = {}
+        self.matcher = RoleMatcher(self.config['invalid_roles'])
         self.bot.add_listener(self.modify_roles, 'on_message')
-        self.bot.add_listener(self.redo_roles_on_create, 'on_guild_role_create')
-        self.bot.add_listener(self.redo_roles_on_delete, 'on_guild_role_delete')
-        self.bot.add_listener(self.redo_roles_on_update, 'on_guild_role_update')
 
-    async def on_ready(self, channels):
-        for channel in channels:
-            self.channels[channel.id] = channel
-            self.guild_to_channel[channel.guild.id] = channel
-            self.channel_info[channel.id] = {}
-            await self.setup_roles(channel)
+    async def add_channel(self, channel, message=None):
+        """Set up the role message of channel, reusing message if it's given."""
+        self.channels[channel.id] = channel
+        self.guild_to_channel[channel.guild.id] = channel
+        self.channel_info[channel.id] = {'message': message}
+        await self.setup_roles(channel)
 
     async def setup_roles(self, channel):
-        if 'message' in self.channel_info[channel.id]:
-            if not self.channel_info[channel.id]['message'] is None:
-                await self.channel_info[channel.id]['message'].delete()
-            self.channel_info[channel.id]['message'] = None
+        """Bring the role message of channel up to date, editing it only if its text changed."""
+        info = self.channel_info[channel.id]
+        message = info.get('message')
 
         # Setup roles
-        self.channel_info[channel.id]['roles'] = []
-        for role in channel.guild.roles:
-            invalid = False
-            for invalid_role in self.config['invalid_roles']:
-                if invalid_role in role.name:
-                    invalid = True
-                    break
-            if not invalid:
-                self.channel_info[channel.id]['roles'].append(role)
-        self.channel_info[channel.id]['roles'].reverse()
-
-        if self.channel_info[channel.id]['roles']:
-            # Send help string
-            help_str = '\nShow your interests and potentially unlock new text channels with these roles:\n'
-            for idx, role in enumerate(self.channel_info[channel.id]['roles']):
-                help_str += '\t\t`{}`: {}\n'.format(idx, role.name)
-            help_str += 'Use `+number` to add or `-number` to remove a role.\n'
-            help_str += 'For example, `+0` will give you the role "{}", and `-0` will remove that role for you.'.format(self.channel_info[channel.id]['roles'][0].name)
-            self.channel_info[channel.id]['message'] = await channel.send(help_str)
-
-    async def redo_roles_on_create(self, role):
-        logger.info('Server created role "{}".'.format(role.name))
-        await self.setup_roles(self.guild_to_channel[role.guild.id])
+        info['roles'] = [role for role in channel.guild.roles if self.matcher.match(role.name) is None]
+        info['roles'].reverse()
 
-    async def redo_roles_on_delete(self, role):
-        logger.info('Server deleted role "{}".'.format(role.name))
-        await self.setup_roles(self.guild_to_channel[role.guild.id])
+        if not info['roles']:
+            if not message is None:
+                await message.delete()
+            info['message'] = None
+            return
 
-    async def redo_roles_on_update(self, before, after):
-        logger.info('Server updated role "{}".'.format(after.name))
-        await self.setup_roles(self.guild_to_channel[after.guild.id])
+        # Send help string
+        help_str = '\nShow your interests and potentially unlock new text channels with these roles:\n'
+        for idx, role in enumerate(info['roles']):
+            help_str += '\t\t`{}`: {}\n'.format(idx, role.name)
+        help_str += 'Use `+number` to add or `-number` to remove a role.\n'
+        help_str += 'For example, `+0` will give you the role "{}", and `-0` will remove that role for you.'.format(info['roles'][0].name)
+        help_str = help_str.strip()
+        if message is None:
+            info['message'] = await channel.send(help_str)
+        elif message.content != help_str:
+            await message.edit(content=help_str)
 
     async def modify_roles(self, message):
         if (message.author == self.bot.user
@@ -324,7 +553,7 @@ class TextRoles(commands.Cog):
 
         # Check role is a valid number
         role = int(message.content[1:])
-        if role < 0 or role > len(self.channel_info[message.channel.id]['roles']):
+        if role < 0 or role >= len(self.channel_info[message.channel.id]['roles']):
             sent = await message.channel.send('Invalid role number.')
             await message.delete(delay=5)
             await sent.delete(delay=5)
@@ -332,31 +561,5 @@ class TextRoles(commands.Cog):
 
         # Modify roles
         role = self.channel_info[message.channel.id]['roles'][role]
-        if message.content[0] == '+':
-            try:
-                await message.author.add_roles(
-                    role,
-                    reason='kokobot message {} at {}'.format(message.id, message.created_at.timestamp()))
-                log = 'Added "{}" role for {}.'.format(role.name, message.author)
-                logger.info(log)
-                sent = await message.channel.send(log)
-                await sent.delete(delay=5)
-            except discord.errors.Forbidden:
-                sent = await message.channel.send('Not enough permissions to add "{}" role for {}. (Check role hierarchy)'.format(role.name, message.author))
-                await sent.delete(delay=5)
-            await message.delete(delay=5)
-        elif message.content[0] == '-':
-            try:
-                await message.author.remove_roles(
-                    role,
-                    reason='kokobot message {} at {}'.format(message.id, message.created_at.timestamp()))
-                log = 'Removed "{}" role for {}.'.format(role.name, message.author)
-                logger.info(log)
-                sent = await message.channel.send(log)
-                await sent.delete(delay=5)
-            except discord.errors.Forbidden:
-                sent = await message.channel.send('Not enough permissions to remove "{}" role for {}. (Check role hierarchy)'.format(role.name, message.author))
-                await sent.delete(delay=5)
-            await message.delete(delay=5)
-        else:
-            sent = await messa
+        self.batcher.change(message.author, role, message.content[0] == '+', message.channel, notify=True)
+        await message.delete(delay=5)
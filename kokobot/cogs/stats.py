@@ -0,0 +1,276 @@
+import asyncio
+import collections
+import datetime
+import logging
+import sqlite3
+import time
+
+from aiohttp import web
+from discord.ext import commands
+
+from ..metrics import registry
+from ..storage import get_storage
+
+logger = logging.getLogger('discord.kokobot.stats')
+
+command_seconds = registry.histogram('kokobot_command_seconds', 'Time of commands.', ('cog', 'command'))
+command_calls = registry.counter('kokobot_commands_total', 'Commands invoked.', ('cog', 'command', 'status'))
+loop_lag_seconds = registry.histogram('kokobot_event_loop_lag_seconds', 'How late the event loop wakes up.')
+
+
+class Stats(commands.Cog):
+    """Metrics of the bot
+
+    Times every command, exposes the metrics registry for Prometheus at
+    http://host:port/metrics and summarizes it with $stats. Commands used
+    are also counted by guild and day in memory, and added to the database
+    in one batch every counts_flush_interval seconds and when the storage
+    closes.
+    """
+    def __init__(self, bot):
+        # config
+        self.config = {
+            'host': '127.0.0.1',
+            'port': 9100,  # None to not expose metrics, processes of run_sharded add their first shard id
+            'lag_interval': 1,  # seconds between checking how late the event loop is
+            'top': 8,  # commands and listeners shown by $stats
+            'counts_table_name': 'command_counts',
+            'counts_flush_interval': 60,  # seconds between writing command counts to the database
+            'counts_top': 20,  # commands shown by $stats commands
+        }
+
+        self.bot = bot
+        self.storage = get_storage(bot)
+        self.runner = None
+        self.lag_task = None
+        self.counts = collections.Counter()  # (guild id, command, day) -> uses not written to the database yet
+        self.counts_task = None
+        self.counts_lock = asyncio.Lock()  # so $stats commands sees each use once, in memory or in the database
+        self.bot.before_invoke(self.before_invoke)
+        self.bot.after_invoke(self.after_invoke)
+        self.bot.add_listener(self.on_ready, 'on_ready')
+        self.storage.add_close_hook(self.flush)
+
+    def __str__(self):
+        return 'kokobot.cogs.Stats'
+
+    async def on_ready(self):
+        self.owner = self.bot.get_user(self.bot.owner_id)
+        if self.lag_task is None:
+            self.lag_task = asyncio.ensure_future(self.measure_lag())
+        if self.runner is None and not self.config['port'] is None:
+            await self.serve()
+        if self.counts_task is None:
+            try:
+                await self.storage.open()
+                await self.storage.migrate(self.config['counts_table_name'], self.migrations())
+                self.counts_task = asyncio.ensure_future(self.flush_counts())
+            except sqlite3.Error as e:
+                logger.info('Database error while setting up command counts: {}'.format(e))
+
+    def migrations(self):
+        table = self.config['counts_table_name']
+        return [
+            (1, f'create table "{table}"', [
+                f'''CREATE TABLE IF NOT EXISTS {table} (
+                    guild INT,
+                    command TEXT,
+                    day TEXT,
+                    count INT,
+                    PRIMARY KEY (guild, command, day)
+                )''',
+                f'CREATE INDEX IF NOT EXISTS {table}_day ON {table} (day)',
+            ]),
+        ]
+
+    async def before_invoke(self, ctx):
+        # Groups and their subcommands are both invoked, time each of them
+        if not hasattr(ctx, 'started'):
+            ctx.started = {}
+        ctx.started[ctx.command.qualified_name] = time.perf_counter()
+
+    async def after_invoke(self, ctx):
+        name = ctx.command.qualified_name
+        started = getattr(ctx, 'started', {}).pop(name, None)
+        cog = ctx.command.cog_name or ''
+        if not started is None:
+            command_seconds.observe(time.perf_counter() - started, cog=cog, command=name)
+        command_calls.inc(cog=cog, command=name, status='failed' if ctx.command_failed else 'ok')
+        # A group that went on to its subcommand is counted as the subcommand
+        if ctx.invoked_subcommand is None or ctx.invoked_subcommand is ctx.command or ctx.command_failed:
+            self.count(ctx)
+
+    def count(self, ctx):
+        """Count a use of a command, only in memory until the next flush.
+
+        Failed commands are counted too, commands that didn't pass their
+        checks never ran and aren't.
+        """
+        guild_id = 0 if ctx.guild is None else ctx.guild.id
+        day = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+        self.counts[(guild_id, ctx.command.qualified_name, day)] += 1
+
+    async def flush_counts(self):
+        """Periodically add the command counts since the last flush to the database."""
+        while True:
+            await asyncio.sleep(self.config['counts_flush_interval'])
+            if not self.counts:
+                continue
+            async with self.counts_lock:
+                await self.write_counts()
+
+    async def write_counts(self):
+        # Called with counts_lock held
+        if not self.counts:
+            return
+        counts, self.counts = self.counts, collections.Counter()
+        try:
+            await self.storage.executemany(
+                f'''INSERT INTO {self.config["counts_table_name"]} (guild, command, day, count) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (guild, command, day) DO UPDATE SET count = count + excluded.count''',
+                [key + (count,) for key, count in counts.items()])
+        except sqlite3.Error as e:
+            logger.info('Database error while flushing command counts: {}'.format(e))
+            self.counts.update(counts)
+
+    async def flush(self):
+        """Stop flushing periodically and write the counts left, before the storage closes."""
+        if self.counts_task is None:
+            return
+        # A flush in progress holds the lock, let it finish instead of cancelling its write
+        async with self.counts_lock:
+            self.counts_task.cancel()
+            try:
+                await self.counts_task
+            except asyncio.CancelledError:
+                pass
+            self.counts_task = None
+            await self.write_counts()
+
+    async def measure_lag(self):
+        interval = self.config['lag_interval']
+        while not self.bot.is_closed():
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            loop_lag_seconds.observe(max(0.0, time.perf_counter() - start - interval))
+
+    async def serve(self):
+        port = self.config['port']
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        if shard_ids:
+            port += shard_ids[0]
+        app = web.Application()
+        app.router.add_get('/metrics', self.metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.config['host'], port).start()
+        except OSError as e:
+            logger.info('Serving metrics on port {} failed: {}'.format(port, e))
+            await runner.cleanup()
+            return
+        self.runner = runner
+        logger.info('Serving metrics at http://{}:{}/metrics'.format(self.config['host'], port))
+
+    async def metrics(self, request):
+        return web.Response(text=registry.expose(), content_type='text/plain', charset='utf-8')
+
+    def top(self, name, label):
+        """Get lines of the series of a histogram that took the most time in total."""
+        metric = registry.get(name)
+        if metric is None:
+            return []
+        lines = []
+        for key, (count, total, p95) in sorted(metric.summary().items(), key=lambda _: -_[1][1])[:self.config['top']]:
+            lines.append('{:<32.32} {:>7} {:>9.1f} {:>9}'.format(
+                key[label], count, total / count * 1000, '>10s' if p95 == float('inf') else '{:.0f}'.format(p95 * 1000)))
+        return lines
+
+    @commands.group(invoke_without_command=True)
+    @commands.is_owner()
+    async def stats(self, ctx):
+        """ -- Show where the bot spends its time (owner only)
+        Usage: $stats
+        """
+        header = '{:<32} {:>7} {:>9} {:>9}'.format('', 'count', 'avg ms', 'p95 ms')
+        lines = ['Commands', header] + self.top('kokobot_command_seconds', 1)
+        lines += ['', 'Listeners', header] + self.top('kokobot_listener_seconds', 1)
+        lines += ['', 'Database', header] + self.top('kokobot_db_query_seconds', 0)
+
+        requests = registry.get('kokobot_rest_requests_total')
+        if not requests is None:
+            lines += ['', 'REST: {} requests, {} rate limited'.format(
+                sum(count for _, _, _, count in requests.samples()), registry.get('kokobot_rest_rate_limits_total').get())]
+        cache = registry.get('kokobot_note_cache')
+        if not cache is None:
+            stats = {key[0]: value for _, _, key, value in cache.samples()}
+            if 'hit_rate' in stats:
+                lines.append('Note cache: {:.1%} hit rate, {} notes'.format(stats['hit_rate'], stats['size']))
+        lag = loop_lag_seconds.summary().get(())
+        if not lag is None:
+            count, total, p95 = lag
+            lines.append('Event loop lag: {:.1f} ms avg, {} p95'.format(
+                total / count * 1000, '>10 s' if p95 == float('inf') else '{:.0f} ms'.format(p95 * 1000)))
+
+        text = '\n'.join(lines)
+        if len(text) > 1990:
+            text = text[:1990 - 4] + '\n...'
+        await ctx.send('```\n{}```'.format(text))
+
+    @stats.command(name='commands')
+    @commands.is_owner()
+    async def command_counts(self, ctx, *args):
+        """ -- Show how often each command was used (owner only)
+        Usage: $stats commands [--since MM-DD-YYYY]
+        Example: $stats commands --since 08-24-2020
+
+        Counts commands of this server, or of all servers in direct messages.
+        """
+        since = None
+        if len(args) > 0:
+            if len(args) != 2 or args[0] != '--since':
+                await ctx.send('Usage: $stats commands [--since MM-DD-YYYY]')
+                return
+            try:
+                since = datetime.datetime.strptime(args[1], "%m-%d-%Y").strftime('%Y-%m-%d')
+            except ValueError:
+                await ctx.send('Invalid date, use MM-DD-YYYY.')
+                return
+
+        where = []
+        params = []
+        if not ctx.guild is None:
+            where.append('guild = (?)')
+            params.append(ctx.guild.id)
+        if not since is None:
+            where.append('day >= (?)')
+            params.append(since)
+        where = ' WHERE ' + ' AND '.join(where) if where else ''
+        async with self.counts_lock:
+            rows = await self.storage.fetchall(
+                f'SELECT command, SUM(count) FROM {self.config["counts_table_name"]}{where} GROUP BY command', params)
+
+            # Add the uses that aren't flushed yet
+            totals = collections.Counter(dict(rows))
+            for (guild_id, command, day), count in self.counts.items():
+                if ((ctx.guild is None or guild_id == ctx.guild.id)
+                        and (since is None or day >= since)):
+                    totals[command] += count
+
+        if not totals:
+            await ctx.send('No commands used{}.'.format('' if since is None else ' since ' + args[1]))
+            return
+        title = 'Commands used{}{}'.format('' if ctx.guild is None else ' in ' + ctx.guild.name,
+                                           '' if since is None else ' since ' + args[1])
+        lines = ['{:<32.32} {:>7}'.format(command, count)
+                 for command, count in totals.most_common(self.config['counts_top'])]
+        await ctx.send('{}\n```\n{}```'.format(title, '\n'.join(lines)))
+
+    @command_counts.error
+    @stats.error
+    async def stats_error(self, ctx, error):
+        if isinstance(error, commands.NotOwner):
+            await ctx.send('Only the owner of Kokobot may see its stats.')
+        else:
+            logger.info('Python error: {}'.format(error))
+            await ctx.send('Bot error, {} pls fix!'.format(self.owner.mention))
@@ -1,6 +1,8 @@
 import asyncio
+import collections
 import datetime
 import logging
+import math
 import typing
 
 import discord
@@ -8,11 +10,75 @@ from discord.ext import commands
 from discord.ext.commands.errors import MissingRequiredArgument
 from discord.errors import Forbidden
 
+from ..members import JoinIndex
+from ..paginator import PageSource, Paginator
+from ..reactions import get_router
+from ..scheduler import get_scheduler
+from ..sessions import get_sessions
+
 logger = logging.getLogger('discord.kokobot.util')
-emoji_bank = {
-    ':left_arrow:': '\U00002B05',
-    ':right_arrow:': '\U000027A1',
-}
+
+
+class MemberListSource(PageSource):
+    """Members of a guild and their join date, as requested by a user.
+
+    Pages are slices of the join index of the guild, starting from the
+    members who joined since a date if one is given. Members with an
+    unknown join date are listed last, or not at all when a date is given.
+    """
+    def __init__(self, user, guild, index, since=None):
+        self.user = user
+        self.guild = guild
+        self.index = index
+        self.since = since
+        self.per_page = 10
+
+    def __str__(self):
+        return 'users for "{}"'.format(self.user)
+
+    def start(self):
+        return 0 if self.since is None else self.index.since(self.since)
+
+    async def count(self):
+        if self.since is None:
+            return len(self.index) + len(self.index.unknown)
+        return len(self.index) - self.start()
+
+    async def fetch(self, page):
+        start = self.start() + page * self.per_page
+        stop = start + self.per_page
+        ids = self.index.slice(start, stop)
+        if self.since is None and stop > len(self.index):
+            unknown = sorted(self.index.unknown)
+            ids += unknown[max(0, start - len(self.index)):stop - len(self.index)]
+        members = [self.guild.get_member(_) for _ in ids]
+        return [m for m in members if not m is None]
+
+    def format(self, page, entries):
+        title = "List of users and their join date, as requested by {}".format(self.user)
+        if not self.since is None:
+            title = "List of users who joined since {}, as requested by {}".format(self.since.strftime("%m-%d-%Y"), self.user)
+        desc = None
+        if len(entries) > 0:
+            desc = ""
+            for i, m in enumerate(entries):
+                timestr = "UNKNOWN: "
+                if not m.joined_at is None:
+                    timestr = m.joined_at.strftime("%m-%d-%Y") + ": "
+                nick = ""
+                if m.nick:
+                    nick = f" ({m.nick})"
+                desc += f"{page*self.per_page + i + 1}. " + timestr + f"{m}{nick}" + "\n"
+        if not self.since is None and len(self.index.unknown) > 0:
+            desc = (desc or "") + f"\n{len(self.index.unknown)} users with an unknown join date are not listed."
+        return discord.Embed(title=title, description=desc, colour=65280)  # Green
+
+    def state(self):
+        return {
+            'user': self.user.id,
+            'guild': self.guild.id,
+            'since': None if self.since is None else self.since.strftime("%m-%d-%Y"),
+        }
 
 
 class Util(commands.Cog):
@@ -21,38 +87,92 @@ class Util(commands.Cog):
     def __init__(self, bot):
         self.messages = {}
         self.bot = bot
+        self.scheduler = get_scheduler(bot)
+        self.router = get_router(bot)
+        self.sessions = get_sessions(bot)
+        self.restored = False
+        self.joins = {}  # guild id -> JoinIndex, built on first use
         self.bot.add_listener(self.on_ready, 'on_ready')
-        self.bot.add_listener(self.react, 'on_reaction_add')
+        self.bot.add_listener(self.on_member_join, 'on_member_join')
+        self.bot.add_listener(self.on_member_remove, 'on_member_remove')
+        self.bot.add_listener(self.on_member_update, 'on_member_update')
+        self.bot.add_listener(self.on_guild_remove, 'on_guild_remove')
 
     def __str__(self):
         return 'kokobot.cogs.Util'
 
     async def on_ready(self):
         self.owner = self.bot.get_user(self.bot.owner_id)
-
-    async def react(self, reaction, user):
-        if (user == self.bot.user
-                or not reaction.emoji in (emoji_bank[':left_arrow:'], emoji_bank[':right_arrow:'])
-                or not reaction.message.id in self.messages):
+        if not self.restored:
+            self.restored = True
+            await self.restore()
+
+    async def restore(self):
+        """Pick up the paginated user lists that were running before a restart."""
+        restored = []
+        for message, state in await self.sessions.restore('users'):
+            # Saved again by list_users() if it still has pages to flip
+            await self.sessions.forget(message.id)
+            guild = self.bot.get_guild(state['guild'])
+            if guild is None:
+                continue
+            user = self.bot.get_user(state['user']) or await self.bot.fetch_user(state['user'])
+            since = state['since']
+            if not since is None:
+                since = datetime.datetime.strptime(since, "%m-%d-%Y")
+            index = await self.join_index(guild)
+            restored.append(self.list_users(message, MemberListSource(user, guild, index, since), state['page']))
+        await asyncio.gather(*restored)
+
+    async def on_member_join(self, member):
+        if member.guild.id in self.joins:
+            self.joins[member.guild.id].add(member)
+
+    async def on_member_remove(self, member):
+        if member.guild.id in self.joins:
+            self.joins[member.guild.id].remove(member.id)
+
+    async def on_member_update(self, before, after):
+        if after.guild.id in self.joins and before.joined_at != after.joined_at:
+            self.joins[after.guild.id].add(after)
+
+    async def on_guild_remove(self, guild):
+        self.joins.pop(guild.id, None)
+
+    async def join_index(self, guild):
+        """Get the join index of a guild, building it from the member cache if needed."""
+        if not guild.id in self.joins:
+            if not guild.chunked:
+                await guild.chunk()
+            self.joins[guild.id] = JoinIndex(guild.members)
+            logger.info('Indexed {} members of {}'.format(len(self.joins[guild.id]), guild))
+        return self.joins[guild.id]
+
+    async def react(self, payload):
+        if not payload.message_id in self.messages:
             return
 
-        logger.info("YO YO YO I GOT PAST THO")
-
-        # Get new page number
-        message_id = reaction.message.id
-        page = self.messages[message_id]['page']
-        if reaction.emoji == emoji_bank[':left_arrow:']:
-            page -= 1
-            if page < 0:
-                page = 0
-        if reaction.emoji == emoji_bank[':right_arrow:']:
-            page += 1
-
-        # Reset message
-        await self.list_users(self.messages[message_id]['message'],
-                              self.messages[message_id]['user'],
-                              page,
-                              self.messages[message_id]['members'])
+        paginator = self.messages[payload.message_id]
+        try:
+            await paginator.react(str(payload.emoji), discord.Object(payload.user_id))
+            await self.save(paginator, later=True)
+        except Exception as e:
+            logger.info('Python error: {}'.format(e))
+            await paginator.message.channel.send('Bot error, {} pls fix!'.format(self.owner.mention))
+
+    def unpaginate(self, paginator):
+        self.messages.pop(paginator.message.id, None)
+        self.router.unregister(paginator.message.id)
+        asyncio.ensure_future(self.sessions.forget(paginator.message.id))
+
+    async def save(self, paginator, later=False):
+        state = paginator.source.state()
+        state['page'] = paginator.page
+        if later:
+            # Flips are saved once they settle, not one write per reaction
+            self.sessions.save_later(paginator.message, 'users', state)
+        else:
+            await self.sessions.save(paginator.message, 'users', state)
 
     @commands.command()
     async def nick(self, ctx, *, nickname: str=""):
@@ -94,6 +214,23 @@ class Util(commands.Cog):
         send_end = datetime.datetime.utcnow().timestamp()
         await message.edit(content='Recieve: `{} ms`\nSend: `{} ms`'.format(int((recv_end - recv_start) * 1000), int((send_end - send_start) * 1000)))
 
+    @commands.command()
+    @commands.is_owner()
+    async def shards(self, ctx):
+        """ -- Show the latency and guilds of each shard in this process (owner only)
+        Usage: $shards
+        """
+        latencies = getattr(self.bot, 'latencies', [(self.bot.shard_id or 0, self.bot.latency)])
+        guilds = collections.Counter(guild.shard_id for guild in self.bot.guilds)
+        lines = []
+        for shard_id, latency in latencies:
+            status = 'up'
+            if hasattr(self.bot, 'get_shard') and self.bot.get_shard(shard_id).is_closed():
+                status = 'closed'
+            latency = 'unknown' if math.isinf(latency) or math.isnan(latency) else '{} ms'.format(int(latency * 1000))
+            lines.append('Shard {}: `{}`, {} guilds, {}'.format(shard_id, latency, guilds[shard_id], status))
+        await ctx.send('\n'.join(lines) or 'No shards.')
+
     @commands.command()
     async def shutdown(self, ctx):
         """ -- Shutdown Kokobot
@@ -177,95 +314,40 @@ class Util(commands.Cog):
         logger.info(f'Purged {len(messages)} of the {count} messages requested by {author}')
 
     @commands.command()
-    async def users(self, ctx):
+    async def users(self, ctx, since: str=None):
         """ -- List all users and their join date.
+        Usage: $users [since]
+        Example: $users 08-24-2020
 
         Prints all users and their join date, sorted by date they joined.
-        This command fails if there are more than 500 users.
+        If since is given as MM-DD-YYYY, only users who joined on or after that date are listed.
         """
+        if ctx.guild is None:
+            await ctx.send('Users can only be listed in a server.')
+            return
+        if not since is None:
+            try:
+                since = datetime.datetime.strptime(since, "%m-%d-%Y")
+            except ValueError:
+                await ctx.send('Invalid date, use MM-DD-YYYY.')
+                return
 
         try:
             message = await ctx.send('Listing users...')
-            guild = ctx.guild
-            members = await guild.fetch_members(limit=None).flatten()
-            members = sorted(members, key=lambda member: member.joined_at)
-            await self.list_users(message, ctx.author, 0, members)
+            index = await self.join_index(ctx.guild)
+            await self.list_users(message, MemberListSource(ctx.author, ctx.guild, index, since))
         except Exception as e:
             logger.info('Python error: {}'.format(e))
             await ctx.send('Bot error, {} pls fix!'.format(self.owner.mention))
 
-    async def clear_message(self, future, message):
-        await asyncio.sleep(120)
-        if not future.cancelled():
-            # FIXME: clear reactions for DMs are unattainable because
-            # 'manage_messages' permission cannot be attained for all DMs
-            await message.clear_reactions()
-            self.messages.pop(message.id)
-
-    async def list_users(self, message, user, page, members):
-        # Cleanup of previous message
-        if message.id in self.messages:
-            self.messages[message.id]['future'].cancel()
-        # FIXME: clear reactions for DMs are unattainable because
-        # 'manage_messages' permission cannot be attained for all DMs
-        await message.clear_reactions()
-
-        MEMBERS = 10  # members to display per page
-        pages = len(members) // MEMBERS
-        if len(members) % MEMBERS > 0:
-            pages += 1
-        # make sure page is within limit
-        if page < 0:
-            page = 0
-        if page > pages - 1:
-            page = pages - 1
-
+    async def list_users(self, message, source, page=0):
         try:
-            title = "List of users and their join date, as requested by {}".format(user)
-            req = members[page*MEMBERS:(page+1)*MEMBERS]
-            desc = None
-            if len(req) > 0:
-                desc = ""
-                for i in range(len(req)):
-                    m = req[i]
-                    timestr = "UNKNOWN: "
-                    if not m.joined_at is None:
-                        timestr = m.joined_at.strftime("%m-%d-%Y") + ": "
-                    nick = ""
-                    if m.nick:
-                        nick = f" ({m.nick})"
-                    desc += f"{page*10 + i + 1}. " + timestr + f"{m}{nick}" + "\n"
-            embed = discord.Embed(title=title, description=desc, colour=65280)  # Green
-            actual_page = page + 1
-            if pages == 0:
-                actual_page = 0
-            embed.set_footer(text=f"Page {actual_page} of {pages}")
-
-            # Edit the message
-            await message.edit(content=None, embed=embed)
-            logger.info('Sent users page {} of {} for "{}"'.format(actual_page, pages, user))
-
-            # React to the message
-            has_more = False
-            if actual_page > 1:
-                has_more = True
-                await message.add_reaction(emoji_bank[':left_arrow:'])
-            if actual_page < pages:
-                has_more = True
-                await message.add_reaction(emoji_bank[':right_arrow:'])
-
-            if has_more:
-                # Add message to messages dict
-                self.messages[message.id] = {}
-                self.messages[message.id]['message'] = message
-                self.messages[message.id]['user'] = user
-                self.messages[message.id]['page'] = page
-                self.messages[message.id]['members'] = members
-
-                # Schedule a future clear of message
-                future = asyncio.Future()
-                asyncio.ensure_future(self.clear_message(future, message))
-                self.messages[message.id]['future'] = future
+            paginator = Paginator(source, self.scheduler, timeout=120,
+                                  on_stop=self.unpaginate)
+            if await paginator.start(message, page):
+                self.messages[message.id] = paginator
+                self.router.register(message.id, self.react)
+                await self.save(paginator)
         except Exception as e:
             logger.info('Python error: {}'.format(e))
             await message.channel.send('Bot error, {} pls fix!'.format(self.owner.mention))
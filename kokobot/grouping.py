@@ -0,0 +1,124 @@
+import collections
+import random as rng
+import time
+
+
+class PairHistory:
+    """How many times pairs of people were put in the same group.
+
+    Only the most recent maxsize pairs are remembered.
+    """
+    def __init__(self, maxsize=50000):
+        self.maxsize = maxsize
+        self.pairs = collections.OrderedDict()  # (a, b) with a < b -> count
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def get(self, a, b):
+        return self.pairs.get((a, b) if a < b else (b, a), 0)
+
+    def record(self, groups, max_group_size=25):
+        """Remember the pairs in groups, skipping groups too large to care about."""
+        for group in groups:
+            if len(group) > max_group_size:
+                continue
+            for i, a in enumerate(group):
+                for b in group[i + 1:]:
+                    pair = (a, b) if a < b else (b, a)
+                    self.pairs[pair] = self.pairs.get(pair, 0) + 1
+                    self.pairs.move_to_end(pair)
+        while len(self.pairs) > self.maxsize:
+            self.pairs.popitem(last=False)
+
+    def neighbors(self, people):
+        """Get {a: {b: count}} of the remembered pairs among people."""
+        people = set(people)
+        neighbors = collections.defaultdict(dict)
+        for (a, b), count in self.pairs.items():
+            if a in people and b in people:
+                neighbors[a][b] = count
+                neighbors[b][a] = count
+        return neighbors
+
+
+def assign_groups(people, groups, keep=(), avoid=(), history=None,
+                  keep_weight=-100.0, avoid_weight=100.0, repeat_weight=1.0,
+                  time_budget=0.02):
+    """Split people into balanced groups.
+
+    Group sizes differ by at most one. keep and avoid are pairs of people
+    that should or shouldn't be in the same group, and pairs that were
+    together more often in history cost more to put together again. All
+    of these are soft, weighted costs that are minimized by a randomized
+    greedy assignment followed by swaps between groups for up to
+    time_budget seconds.
+
+    Returns a list of groups, each a list of people.
+    """
+    people = list(people)
+    rng.shuffle(people)
+    if len(people) == 0:
+        return [[] for _ in range(groups)]
+
+    # Sparse pair weights, only people with constraints or history have any
+    weights = collections.defaultdict(lambda: collections.defaultdict(float))
+    if not history is None:
+        for a, counts in history.neighbors(people).items():
+            for b, count in counts.items():
+                weights[a][b] += repeat_weight * count
+    members = set(people)
+    for pairs, weight in ((keep, keep_weight), (avoid, avoid_weight)):
+        for a, b in pairs:
+            if a in members and b in members and a != b:
+                weights[a][b] += weight
+                weights[b][a] += weight
+
+    # Balanced target sizes
+    base, extra = divmod(len(people), groups)
+    capacity = [base + 1 if g < extra else base for g in range(groups)]
+    assigned = {}  # person -> group
+    result = [[] for _ in range(groups)]
+
+    def cost(person, group):
+        return sum(w for other, w in weights.get(person, {}).items() if assigned.get(other) == group)
+
+    # Greedy: constrained people first, each into the cheapest group with room
+    constrained = sorted([p for p in people if p in weights], key=lambda p: -len(weights[p]))
+    for person in constrained:
+        open_groups = [g for g in range(groups) if len(result[g]) < capacity[g]]
+        group = min(open_groups, key=lambda g: (cost(person, g), len(result[g])))
+        assigned[person] = group
+        result[group].append(person)
+
+    # Everyone else fills up the room that is left
+    slots = [g for g in range(groups) for _ in range(capacity[g] - len(result[g]))]
+    for person, group in zip([p for p in people if not p in weights], slots):
+        assigned[person] = group
+        result[group].append(person)
+
+    # Local search: swap constrained people with anyone in another group
+    if constrained and groups > 1:
+        deadline = time.monotonic() + time_budget
+        iterations = 0
+        while iterations < max(2000, 50 * len(people)):
+            iterations += 1
+            if iterations % 64 == 0 and time.monotonic() > deadline:
+                break
+            a = rng.choice(constrained)
+            ga = assigned[a]
+            gb = rng.randrange(groups - 1)
+            if gb >= ga:
+                gb += 1
+            if not result[gb]:
+                continue
+            ib = rng.randrange(len(result[gb]))
+            b = result[gb][ib]
+            wab = weights[a].get(b, 0.0)
+            delta = (cost(a, gb) - wab - cost(a, ga)
+                     + cost(b, ga) - wab - cost(b, gb))
+            if delta < 0:
+                ia = result[ga].index(a)
+                result[ga][ia], result[gb][ib] = b, a
+                assigned[a], assigned[b] = gb, ga
+    return result
@@ -0,0 +1,57 @@
+import collections
+import datetime
+import json
+import logging
+import time
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through at most rate records per second from each logging call.
+
+    Records are grouped by the line that logged them, since messages are
+    formatted before they're logged. Records above the rate are dropped and
+    counted, the next record let through from that line says how many were
+    dropped. Records at level or above are never dropped.
+    """
+    def __init__(self, rate=20, burst=None, level=logging.WARNING):
+        super().__init__()
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.level = level
+        self.buckets = {}  # (path, line) -> [tokens, last refill]
+        self.dropped = collections.Counter()  # (path, line) -> records dropped since the last one let through
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            self.dropped[key] += 1
+            return False
+        bucket[0] -= 1
+        dropped = self.dropped.pop(key, 0)
+        if dropped > 0:
+            record.msg = '{} ({} similar messages dropped)'.format(record.getMessage(), dropped)
+            record.args = None
+        return True
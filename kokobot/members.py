@@ -0,0 +1,58 @@
+import bisect
+
+
+class JoinIndex:
+    """Member ids of a guild sorted by the date they joined.
+
+    Kept up to date with add() and remove() as members join and leave, so
+    listing members by join date is a slice and finding who joined since a
+    date is a binary search. Members with an unknown join date aren't
+    indexed, they're kept in unknown instead.
+    """
+    def __init__(self, members=()):
+        self.joined = {}  # member id -> sort key
+        self.keys = []  # sorted (joined_at, member id)
+        self.unknown = set()  # ids of members with an unknown join date
+        for member in members:
+            if member.joined_at is None:
+                self.unknown.add(member.id)
+            else:
+                self.joined[member.id] = self.key(member)
+        self.keys = sorted(self.joined.values())
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, member_id):
+        return member_id in self.joined or member_id in self.unknown
+
+    @staticmethod
+    def key(member):
+        return (member.joined_at, member.id)
+
+    def add(self, member):
+        """Add a member, or move them if their join date changed."""
+        if member.joined_at is None:
+            self.remove(member.id)
+            self.unknown.add(member.id)
+            return
+        key = self.key(member)
+        if self.joined.get(member.id) == key:
+            return
+        self.remove(member.id)
+        self.joined[member.id] = key
+        bisect.insort(self.keys, key)
+
+    def remove(self, member_id):
+        self.unknown.discard(member_id)
+        key = self.joined.pop(member_id, None)
+        if not key is None:
+            i = bisect.bisect_left(self.keys, key)
+            del self.keys[i]
+
+    def since(self, date):
+        """Get the position of the first member who joined at or after date."""
+        return bisect.bisect_left(self.keys, (date, 0))
+
+    def slice(self, start, stop):
+        return [member_id for _, member_id in self.keys[start:stop]]
@@ -0,0 +1,170 @@
+import abc
+import bisect
+import contextlib
+import threading
+import time
+
+# Seconds, from a cached lookup to a slow REST call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric(abc.ABC):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}  # label values -> value
+        # Observed from the event loop and the database threads
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels.get(_, '') for _ in self.labels)
+
+    @abc.abstractmethod
+    def samples(self):
+        """Get [(suffix, label names, label values, value)] to expose."""
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, names, values, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, format_labels(names, values), value))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """A count that only goes up, its name should end with _total."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            return [('', self.labels, key, value) for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    """A value read from fn() when exposed, fn returns {label values: value} if there are labels."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn, labels=()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        if not self.labels:
+            return [('', (), (), value)]
+        return [('', self.labels, key, v) for key, v in sorted(value.items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                # Count per bucket, then the sum and count of everything
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def summary(self):
+        """Get {label values: (count, sum, approximate p95)}."""
+        with self.lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+        summary = {}
+        for key, (counts, total, count) in series.items():
+            p95 = float('inf')
+            seen = 0
+            for bound, bucket in zip(self.buckets, counts):
+                seen += bucket
+                if seen >= 0.95 * count:
+                    p95 = bound
+                    break
+            summary[key] = (count, total, p95)
+        return summary
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items())
+        samples = []
+        names = self.labels + ('le',)
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                samples.append(('_bucket', names, key + (repr(bound),), cumulative))
+            samples.append(('_bucket', names, key + ('+Inf',), count))
+            samples.append(('_sum', self.labels, key, total))
+            samples.append(('_count', self.labels, key, count))
+        return samples
+
+
+class Registry:
+    """Metrics of the bot, exposed in the Prometheus text format.
+
+    Metrics are registered once by name, registering a name again returns
+    the metric that's already there, or replaces it for gauges.
+    """
+    def __init__(self):
+        self.metrics = {}  # name -> Metric
+
+    def counter(self, name, help, labels=()):
+        if not name in self.metrics:
+            self.metrics[name] = Counter(name, help, labels)
+        return self.metrics[name]
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        if not name in self.metrics:
+            self.metrics[name] = Histogram(name, help, labels, buckets)
+        return self.metrics[name]
+
+    def gauge(self, name, help, fn, labels=()):
+        self.metrics[name] = Gauge(name, help, fn, labels)
+        return self.metrics[name]
+
+    def get(self, name):
+        return self.metrics.get(name)
+
+    def expose(self):
+        return '\n'.join(metric.expose() for _, metric in sorted(self.metrics.items())) + '\n'
+
+
+# Shared by everything in the process, like the logging module
+registry = Registry()
@@ -0,0 +1,172 @@
+import abc
+import asyncio
+import collections
+import logging
+import math
+
+import discord
+
+logger = logging.getLogger('discord.kokobot.paginator')
+emoji_bank = {
+    ':left_arrow:': '\U00002B05',
+    ':right_arrow:': '\U000027A1',
+}
+
+
+class PageSource(abc.ABC):
+    """Pages of entries shown by a Paginator.
+
+    Subclasses implement count(), fetch() and format(), and state() if the
+    pages can be shown again after a restart. Pages may be
+    fetched concurrently and out of order, but always after the page before
+    or after them, so a source can remember where a page ended to seek to
+    the next one.
+    """
+    per_page = 10
+
+    @abc.abstractmethod
+    async def count(self):
+        """Get the total number of entries."""
+
+    @abc.abstractmethod
+    async def fetch(self, page):
+        """Get the entries on a page."""
+
+    @abc.abstractmethod
+    def format(self, page, entries):
+        """Create the embed of a page, the footer is added by the Paginator."""
+
+    def state(self):
+        """Get a JSON-serializable dict to recreate the source from after a restart, or None."""
+        return None
+
+
+class ListSource(PageSource):
+    """Pages over a list that is already in memory."""
+    def __init__(self, entries, per_page=10):
+        self.entries = entries
+        self.per_page = per_page
+
+    async def count(self):
+        return len(self.entries)
+
+    async def fetch(self, page):
+        return self.entries[page * self.per_page:(page + 1) * self.per_page]
+
+
+class Paginator:
+    """Shows a PageSource on a message, flipped with arrow reactions.
+
+    Rendered pages are kept in a small cache per session, and the pages next
+    to the one shown are rendered in the background so flipping to them
+    doesn't wait on the source. The session stops after timeout seconds
+    without a flip, timed by scheduler, then on_stop(paginator) is called.
+    """
+    def __init__(self, source, scheduler, timeout=60, cache_pages=5, on_stop=None):
+        self.source = source
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self.cache_pages = cache_pages
+        self.on_stop = on_stop
+        self.message = None
+        self.page = 0
+        self.pages = 0
+        self.rendered = collections.OrderedDict()  # page -> task rendering the embed
+        self.lock = asyncio.Lock()
+
+    @property
+    def has_more(self):
+        return self.pages > 1
+
+    async def start(self, message, page=0):
+        """Show the first page on message, returns whether there are other pages to flip to."""
+        self.message = message
+        count = await self.source.count()
+        self.pages = math.ceil(count / self.source.per_page)
+        await self.show(max(0, min(page, self.pages - 1)))
+
+        if self.has_more:
+            await message.add_reaction(emoji_bank[':left_arrow:'])
+            await message.add_reaction(emoji_bank[':right_arrow:'])
+            self.reset_timeout()
+        return self.has_more
+
+    async def build(self, page):
+        entries = await self.source.fetch(page)
+        embed = self.source.format(page, entries)
+        actual_page = page + 1
+        if self.pages == 0:
+            actual_page = 0
+        embed.set_footer(text=f"Page {actual_page} of {self.pages}")
+        return embed
+
+    def render(self, page):
+        """Get the task rendering the embed of page, through the cache."""
+        task = self.rendered.get(page)
+        if task is None or (task.done() and (task.cancelled() or not task.exception() is None)):
+            task = asyncio.ensure_future(self.build(page))
+            task.add_done_callback(self.log_render_error)
+            self.rendered[page] = task
+        self.rendered.move_to_end(page)
+        while len(self.rendered) > self.cache_pages:
+            self.rendered.popitem(last=False)
+        return task
+
+    def log_render_error(self, task):
+        if not task.cancelled() and not task.exception() is None:
+            logger.info('Rendering {} failed: {}'.format(self.source, task.exception()))
+
+    def prefetch(self):
+        for page in (self.page + 1, self.page - 1):
+            if 0 <= page < self.pages:
+                self.render(page)
+
+    async def show(self, page):
+        embed = await self.render(page)
+        await self.message.edit(content=None, embed=embed)
+        self.page = page
+        logger.info('Sent {} page {} of {}'.format(self.source, page + 1, self.pages))
+        self.prefetch()
+
+    async def flip(self, delta):
+        async with self.lock:
+            page = self.page + delta
+            if 0 <= page < self.pages and page != self.page:
+                await self.show(page)
+        self.reset_timeout()
+
+    async def react(self, emoji, user):
+        """Flip the page for an arrow reaction from user."""
+        if emoji == emoji_bank[':left_arrow:']:
+            delta = -1
+        elif emoji == emoji_bank[':right_arrow:']:
+            delta = 1
+        else:
+            return
+        asyncio.ensure_future(self.remove_reaction(emoji, user))
+        await self.flip(delta)
+
+    async def remove_reaction(self, emoji, user):
+        # FIXME: removing reactions of others in DMs is unattainable because
+        # 'manage_messages' permission cannot be attained for all DMs
+        try:
+            await self.message.remove_reaction(emoji, user)
+        except discord.HTTPException:
+            pass
+
+    def reset_timeout(self):
+        self.scheduler.schedule(('paginator', self.message.id), self.timeout, self.stop)
+
+    async def stop(self):
+        self.scheduler.cancel(('paginator', self.message.id))
+        for task in self.rendered.values():
+            task.cancel()
+        self.rendered.clear()
+        if not self.on_stop is None:
+            self.on_stop(self)
+        # FIXME: clear reactions for DMs are unattainable because
+        # 'manage_messages' permission cannot be attained for all DMs
+        try:
+            await self.message.clear_reactions()
+        except discord.HTTPException:
+            pass
@@ -0,0 +1,55 @@
+import logging
+
+logger = logging.getLogger('discord.kokobot.reactions')
+
+
+class ReactionRouter:
+    """Routes raw reaction events to the handler of their message.
+
+    Cogs register handlers for the interactive messages they own, so every
+    reaction is looked up once by message id and goes to at most one
+    handler. Raw events are used so messages that have left the message
+    cache of discord.py still get their reactions. Handlers are coroutine
+    functions taking the RawReactionActionEvent, reactions of the bot itself
+    are never routed.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.handlers = {}  # message id -> (handler of adds, handler of removes)
+        self.bot.add_listener(self.on_raw_reaction_add, 'on_raw_reaction_add')
+        self.bot.add_listener(self.on_raw_reaction_remove, 'on_raw_reaction_remove')
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def __contains__(self, message_id):
+        return message_id in self.handlers
+
+    def register(self, message_id, on_add, on_remove=None):
+        """Route reactions on a message to on_add and on_remove, replacing any earlier handlers."""
+        self.handlers[message_id] = (on_add, on_remove)
+
+    def unregister(self, message_id):
+        self.handlers.pop(message_id, None)
+
+    async def on_raw_reaction_add(self, payload):
+        await self.dispatch(payload, 0)
+
+    async def on_raw_reaction_remove(self, payload):
+        await self.dispatch(payload, 1)
+
+    async def dispatch(self, payload, index):
+        handlers = self.handlers.get(payload.message_id)
+        if handlers is None or handlers[index] is None or payload.user_id == self.bot.user.id:
+            return
+        try:
+            await handlers[index](payload)
+        except Exception as e:
+            logger.info('Reaction handler {} raised: {}'.format(handlers[index], e))
+
+
+def get_router(bot):
+    """Get the reaction router shared by every cog of this bot, creating it if needed."""
+    if getattr(bot, 'router', None) is None:
+        bot.router = ReactionRouter(bot)
+    return bot.router
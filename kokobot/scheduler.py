@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import math
+
+logger = logging.getLogger('discord.kokobot.scheduler')
+
+
+class Scheduler:
+    """Runs callbacks after a delay for all cogs from a single task.
+
+    Timers live in a hashed timing wheel of `slots` buckets of `tick`
+    seconds each, so scheduling, rescheduling and cancelling a timer are
+    O(1). Every tick, the callbacks that are due are fired together.
+    Callbacks take no arguments and may be coroutine functions.
+    """
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.wheel = [set() for _ in range(slots)]
+        self.timers = {}  # key -> (tick it fires on, callback)
+        self.last_tick = None
+        self.task = None
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def now(self):
+        return int(asyncio.get_event_loop().time() / self.tick)
+
+    def schedule(self, key, delay, callback):
+        """Call callback after delay seconds, replacing the timer of key if there is one."""
+        self.cancel(key)
+        if self.task is None:
+            self.last_tick = self.now()
+            self.task = asyncio.ensure_future(self.run())
+        # Round the time it's due up to a tick, so a timer never fires early
+        tick = max(self.now() + 1, math.ceil((asyncio.get_event_loop().time() + delay) / self.tick))
+        self.timers[key] = (tick, callback)
+        self.wheel[tick % len(self.wheel)].add(key)
+
+    def cancel(self, key):
+        timer = self.timers.pop(key, None)
+        if not timer is None:
+            self.wheel[timer[0] % len(self.wheel)].discard(key)
+
+    def due(self, tick):
+        callbacks = []
+        slot = self.wheel[tick % len(self.wheel)]
+        for key in [key for key in slot if self.timers[key][0] <= tick]:
+            slot.discard(key)
+            callbacks.append(self.timers.pop(key)[1])
+        return callbacks
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep((self.last_tick + 1) * self.tick - loop.time())
+            now = self.now()
+            callbacks = []
+            for tick in range(self.last_tick + 1, now + 1):
+                callbacks.extend(self.due(tick))
+            self.last_tick = now
+            if callbacks:
+                asyncio.ensure_future(self.fire(callbacks))
+
+    async def fire(self, callbacks):
+        results = []
+        for callback in callbacks:
+            try:
+                results.append(callback())
+            except Exception as e:
+                logger.info('Scheduled callback {} raised: {}'.format(callback, e))
+        results = await asyncio.gather(*[r for r in results if asyncio.iscoroutine(r)],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.info('Scheduled callback raised: {}'.format(result))
+
+
+def get_scheduler(bot):
+    """Get the scheduler shared by every cog of this bot, creating it if needed."""
+    if getattr(bot, 'scheduler', None) is None:
+        bot.scheduler = Scheduler()
+    return bot.scheduler
@@ -1,42 +1,156 @@
-import datetime
+import asyncio
+import atexit
 import logging
+import logging.handlers
+import math
+import multiprocessing
 import os
+import queue
+import sqlite3
+import time
 
 import discord
 from discord.ext import commands
 
 from . import cogs
+from .logs import JsonFormatter, SamplingFilter
+from .metrics import registry
+from .storage import get_storage
 
+listener_seconds = registry.histogram('kokobot_listener_seconds', 'Time of event listeners.', ('event', 'listener'))
+rest_requests = registry.counter('kokobot_rest_requests_total', 'Discord REST requests.', ('method', 'route', 'status'))
+rest_rate_limits = registry.counter('kokobot_rest_rate_limits_total', 'Discord REST requests that were rate limited (429).')
 
-def setup_logging():
+# Listener and REST metrics hook into undocumented parts of discord.py:
+# Client._run_event(coro, event_name, *args, **kwargs), which runs every
+# listener, HTTPClient.request(route, **kwargs), which sends every REST
+# request, and the "rate limited" warning of the discord.http logger.
+# They're only known to work this way from 1.5 to 1.7, with other versions
+# those metrics are left out.
+INSTRUMENT_INTERNALS = discord.version_info.major == 1 and 5 <= discord.version_info.minor <= 7
+
+
+def setup_logging(name=None, json_format=False, max_bytes=10 * 1024 * 1024, backup_count=10,
+                  rotate_when=None, sample_rate=20):
+    """Log the discord logger to a rotating file and stderr without blocking.
+
+    Records are put on a queue and written by a background thread, so a
+    slow disk or terminal never stalls the event loop. The file rotates at
+    max_bytes, or every rotate_when (as in TimedRotatingFileHandler) if
+    given. Info records beyond sample_rate per second from the same line
+    are dropped.
+    """
     logger = logging.getLogger('discord')
     logger.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s:%(levelname)s [%(name)s]: %(message)s')
+    if json_format:
+        formatter = JsonFormatter()
 
     # log to file
     os.makedirs('log', exist_ok=True)
-    file_handler = logging.FileHandler(
-        filename='log/{}.log'.format(int(datetime.datetime.utcnow().timestamp())),
-        encoding='utf-8', mode='w')
+    filename = 'log/kokobot{}.log'.format('' if name is None else '-' + name)
+    if rotate_when is None:
+        file_handler = logging.handlers.RotatingFileHandler(
+            filename=filename, encoding='utf-8', maxBytes=max_bytes, backupCount=backup_count)
+    else:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            filename=filename, encoding='utf-8', when=rotate_when, backupCount=backup_count)
     file_handler.setFormatter(formatter)
     file_handler.setLevel(logging.INFO)
-    logger.addHandler(file_handler)
 
     # log to stderr
     stderr_handler = logging.StreamHandler()
     stderr_handler.setLevel(logging.INFO)
     stderr_handler.setFormatter(formatter)
-    logger.addHandler(stderr_handler)
+
+    # Only the queue is written to on the event loop
+    records = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(rate=sample_rate))
+    logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(records, file_handler, stderr_handler,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
 
     return logger
 
+class RateLimitCounter(logging.Filter):
+    """Counts the 429 responses discord.py logs before retrying them."""
+    def filter(self, record):
+        if 'rate limited' in record.getMessage():
+            rest_rate_limits.inc()
+        return True
+
+class KokobotMixin:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.announced = False
+        if INSTRUMENT_INTERNALS:
+            self.instrument()
+        else:
+            logging.getLogger('discord').info(
+                'Listener and REST metrics are not supported with discord.py %s, leaving them out' % discord.__version__)
+
+    def instrument(self):
+        # Count the REST requests by route
+        request = self.http.request
+        async def counted_request(route, **kwargs):
+            status = 'ok'
+            try:
+                return await request(route, **kwargs)
+            except discord.HTTPException as e:
+                status = str(e.status)
+                raise
+            except Exception:
+                status = 'error'
+                raise
+            finally:
+                rest_requests.inc(method=route.method, route=route.path, status=status)
+        self.http.request = counted_request
+        logging.getLogger('discord.http').addFilter(RateLimitCounter())
+
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        # Time every listener, this is what every event goes through
+        if not INSTRUMENT_INTERNALS:
+            return await super()._run_event(coro, event_name, *args, **kwargs)
+        with listener_seconds.time(event=event_name, listener=getattr(coro, '__qualname__', str(coro))):
+            await super()._run_event(coro, event_name, *args, **kwargs)
+
+    async def close(self):
+        await super().close()
+        # Close shared services after the cogs have stopped using them
+        if not getattr(self, 'storage', None) is None:
+            await self.storage.close()
+
+class Kokobot(KokobotMixin, commands.Bot):
+    pass
+
+class ShardedKokobot(KokobotMixin, commands.AutoShardedBot):
+    pass
+
+def shard_name(shard_ids):
+    return 'shards-{}-{}'.format(shard_ids[0], shard_ids[-1])
+
 def run(
     client_id,
     token,
     owner_id=None,
     custom_cogs=[],
+    shard_count=None,
+    shard_ids=None,
+    log_json=False,
+    announce_interval=24 * 60 * 60,
 ):
-    logger = setup_logging()
+    """Run the bot until it's shut down.
+
+    By default the bot runs as one unsharded client. With shard_count, it
+    runs as an AutoShardedBot with the shards in shard_ids, or all of them.
+    With log_json, logs are written as one JSON object per line. The bot
+    says it's ready in the #bot channel of a guild at most once every
+    announce_interval seconds, across restarts and processes.
+    """
+    logger = setup_logging(None if shard_ids is None else shard_name(shard_ids), json_format=log_json)
 
     # requested permissions
     permissions = discord.Permissions(permissions=0)
@@ -62,9 +176,16 @@ def run(
     intents.messages = True
     intents.guilds = True
     intents.reactions = True
+    intents.emojis = True
 
-    bot = commands.Bot(command_prefix='$', description="Kokobot for UT Austin SASE",
-                       intents=intents, owner_id=owner_id)
+    if shard_count is None:
+        bot = Kokobot(command_prefix='$', description="Kokobot for UT Austin SASE",
+                      intents=intents, owner_id=owner_id)
+    else:
+        bot = ShardedKokobot(command_prefix='$', description="Kokobot for UT Austin SASE",
+                             intents=intents, owner_id=owner_id,
+                             shard_count=shard_count, shard_ids=shard_ids)
+    storage = get_storage(bot, 'kokobot.db')
 
     # append cogs
     default_cogs = [
@@ -72,6 +193,8 @@ def run(
         # cogs.Roles,  # removing roles since folks didn't want it anymore
         cogs.Koko,
         cogs.Random,
+        cogs.Stats,
+        cogs.Emojis,
     ]
     logger.info('Loading extensions:')
     for cog in default_cogs:
@@ -90,10 +213,110 @@ def run(
         logger.info('Invite me at: \n\n\t%s\n' % discord.utils.oauth_url(client_id, permissions=permissions))
         logger.info('--------------------------------------------------------')
         logger.info('Servers connected to:')
+        channels = []
         for guild in bot.guilds:
             logger.info('\t%s' % guild.name)
             for channel in guild.channels:
                 if channel.name == 'bot':
-                    await channel.send('Kokobot is ready! Use `$help` for more information.')
+                    channels.append(channel)
+
+        # on_ready fires again on reconnects, only announce the first time
+        if bot.announced:
+            return
+        bot.announced = True
+
+        # Guilds that were told recently, before a restart or by another process
+        now = int(time.time())
+        try:
+            await storage.open()
+            await storage.migrate('announcements', [
+                (1, 'create table "announcements"', [
+                    'CREATE TABLE IF NOT EXISTS announcements (guild INT PRIMARY KEY, date INT)',
+                ]),
+            ])
+            rows = await storage.fetchall('SELECT guild FROM announcements WHERE date >= (?)',
+                                          (now - announce_interval,))
+        except sqlite3.Error as e:
+            logger.info('Database error, not announcing: %s' % e)
+            return
+        announced = set(row[0] for row in rows)
+        channels = [channel for channel in channels if not channel.guild.id in announced]
+
+        results = await asyncio.gather(
+            *[channel.send('Kokobot is ready! Use `$help` for more information.') for channel in channels],
+            return_exceptions=True)
+        guilds = set()
+        for channel, result in zip(channels, results):
+            if isinstance(result, Exception):
+                logger.info('Announcing in #%s of %s failed: %s' % (channel.name, channel.guild.name, result))
+            else:
+                guilds.add(channel.guild.id)
+        logger.info('Announced in %d guilds, %d were announced recently' % (len(guilds), len(announced)))
+        try:
+            await storage.executemany('INSERT OR REPLACE INTO announcements VALUES (?, ?)',
+                                      [(guild, now) for guild in guilds])
+        except sqlite3.Error as e:
+            logger.info('Database error while saving announcements: %s' % e)
+
+    @bot.event
+    async def on_shard_ready(shard_id):
+        logger.info('Shard %d is ready, %d guilds' % (shard_id, len([_ for _ in bot.guilds if _.shard_id == shard_id])))
+
+    @bot.event
+    async def on_shard_disconnect(shard_id):
+        logger.info('Shard %d disconnected' % shard_id)
+
+    @bot.event
+    async def on_shard_resumed(shard_id):
+        logger.info('Shard %d resumed, latency %.0f ms' % (shard_id, bot.get_shard(shard_id).latency * 1000))
 
     bot.run(token)
+
+def run_sharded(
+    client_id,
+    token,
+    shard_count,
+    processes=None,
+    owner_id=None,
+    custom_cogs=[],
+    identify_delay=5,
+    log_json=False,
+):
+    """Run shard_count shards split into contiguous ranges over several processes.
+
+    Each process runs an AutoShardedBot for its range of shards, all of
+    them share the same database. processes defaults to one per CPU.
+    Processes are started identify_delay seconds per shard apart, Discord
+    only allows identifying one shard at a time.
+
+    Processes are spawned, so each of them imports the script that called
+    run_sharded again. The script must only call it under
+    `if __name__ == '__main__':`, a RuntimeError is raised otherwise.
+    """
+    if multiprocessing.current_process().name != 'MainProcess':
+        raise RuntimeError('run_sharded was called again from a shard process, '
+                           "call it under `if __name__ == '__main__':` in your script")
+    logger = setup_logging('launcher', json_format=log_json)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, shard_count))
+    per_process = math.ceil(shard_count / processes)
+    groups = [list(range(start, min(start + per_process, shard_count)))
+              for start in range(0, shard_count, per_process)]
+
+    # spawn so every process starts with a fresh event loop and connections
+    context = multiprocessing.get_context('spawn')
+    workers = []
+    for shard_ids in groups:
+        worker = context.Process(target=run, name='kokobot-{}'.format(shard_name(shard_ids)),
+                                 args=(client_id, token, owner_id, custom_cogs),
+                                 kwargs={'shard_count': shard_count, 'shard_ids': shard_ids, 'log_json': log_json})
+        worker.start()
+        workers.append(worker)
+        logger.info('Started process %d for shards %s' % (worker.pid, shard_ids))
+        if shard_ids != groups[-1]:
+            time.sleep(identify_delay * len(shard_ids))
+
+    for worker in workers:
+        worker.join()
+        logger.info('Process %d for %s exited with %s' % (worker.pid, worker.name, worker.exitcode))
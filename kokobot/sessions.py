@@ -0,0 +1,119 @@
+import asyncio
+import functools
+import json
+import logging
+import time
+
+import discord
+
+from .scheduler import get_scheduler
+from .storage import get_storage
+
+logger = logging.getLogger('discord.kokobot.sessions')
+
+
+class SessionStore:
+    """Keeps the state of interactive messages in the database across restarts.
+
+    Cogs save() a JSON-serializable state for each interactive message they
+    run, under a kind naming what the message is, and forget() it when the
+    message stops. After a restart, restore(kind) gives back the messages
+    of a kind that are still around along with their state. Sessions older
+    than max_age seconds are dropped instead. State that changes often,
+    like the page shown, is saved with save_later() so only the last change
+    within save_delay seconds is written.
+    """
+    def __init__(self, bot, table_name='sessions', max_age=24 * 60 * 60, save_delay=10):
+        self.bot = bot
+        self.storage = get_storage(bot)
+        self.scheduler = get_scheduler(bot)
+        self.table_name = table_name
+        self.max_age = max_age
+        self.save_delay = save_delay
+        self.opened = False
+
+    def migrations(self):
+        table = self.table_name
+        return [
+            (1, f'create table "{table}"', [
+                f'''CREATE TABLE IF NOT EXISTS {table} (
+                    message INT PRIMARY KEY,
+                    channel INT,
+                    kind TEXT,
+                    state TEXT,
+                    date INT
+                )''',
+                f'CREATE INDEX IF NOT EXISTS {table}_kind ON {table} (kind)',
+            ]),
+        ]
+
+    async def open(self):
+        if self.opened:
+            return
+        await self.storage.open()
+        await self.storage.migrate('sessions', self.migrations())
+        self.opened = True
+
+    async def save(self, message, kind, state):
+        """Save the state of an interactive message, replacing what was saved before."""
+        try:
+            await self.storage.submit(
+                f'INSERT OR REPLACE INTO {self.table_name} VALUES (?, ?, ?, ?, ?)',
+                (message.id, message.channel.id, kind, json.dumps(state), int(time.time())))
+        except Exception as e:
+            logger.info('Saving session of message {} failed: {}'.format(message.id, e))
+
+    def save_later(self, message, kind, state):
+        """Save the state of an interactive message after save_delay seconds, unless it changes again."""
+        self.scheduler.schedule(('session', message.id), self.save_delay,
+                                functools.partial(self.save, message, kind, state))
+
+    async def forget(self, message_id):
+        self.scheduler.cancel(('session', message_id))
+        try:
+            await self.storage.submit(f'DELETE FROM {self.table_name} WHERE message = (?)', (message_id,))
+        except Exception as e:
+            logger.info('Forgetting session of message {} failed: {}'.format(message_id, e))
+
+    def owns(self, channel):
+        """Whether channel is handled by this process, when shards run in several processes."""
+        guild = getattr(channel, 'guild', None)
+        if guild is None:
+            # Direct messages go to shard 0
+            shard_ids = getattr(self.bot, 'shard_ids', None)
+            return shard_ids is None or 0 in shard_ids
+        return not self.bot.get_guild(guild.id) is None
+
+    async def restore(self, kind):
+        """Get [(message, state)] of the saved sessions of kind whose messages still exist."""
+        await self.open()
+        await self.storage.execute(f'DELETE FROM {self.table_name} WHERE date < (?)',
+                                   (int(time.time()) - self.max_age,))
+        rows = await self.storage.fetchall(
+            f'SELECT message, channel, state FROM {self.table_name} WHERE kind = (?)', (kind,))
+
+        async def fetch(message_id, channel_id, state):
+            try:
+                channel = self.bot.get_channel(channel_id)
+                if channel is None:
+                    channel = await self.bot.fetch_channel(channel_id)
+                if not self.owns(channel):
+                    return None
+                return (await channel.fetch_message(message_id), json.loads(state))
+            except discord.HTTPException as e:
+                logger.info('Dropping session of message {}: {}'.format(message_id, e))
+                await self.forget(message_id)
+                return None
+
+        # Messages of all channels and guilds are fetched at the same time
+        sessions = await asyncio.gather(*[fetch(*row) for row in rows])
+        sessions = [_ for _ in sessions if not _ is None]
+        logger.info('Restored {} {} sessions'.format(len(sessions), kind))
+        return sessions
+
+
+def get_sessions(bot):
+    """Get the session store shared by every cog of this bot, creating it if needed."""
+    if getattr(bot, 'sessions', None) is None:
+        bot.sessions = SessionStore(bot)
+    return bot.sessions
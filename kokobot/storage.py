@@ -0,0 +1,300 @@
+import asyncio
+import concurrent.futures
+import logging
+import sqlite3
+import threading
+
+from .metrics import registry
+
+logger = logging.getLogger('discord.kokobot.storage')
+query_seconds = registry.histogram('kokobot_db_query_seconds', 'Time of database calls.', ('executor',))
+
+
+class Storage:
+    """Async access to the sqlite database shared by all cogs.
+
+    All writes go through one long-lived writer connection owned by a
+    dedicated thread, so they are serialized without blocking the event loop.
+    Reads run on a small pool of threads, each with its own connection, so
+    they can run at the same time as each other and as the writer.
+    Every connection keeps a cache of prepared statements.
+
+    The database is put in WAL mode so readers never wait on the writer,
+    and schema changes are applied as numbered migrations with migrate().
+
+    Small writes should go through submit(), which queues them up and
+    commits up to batch_size of them together every batch_delay seconds.
+    Each commit waits for the disk, so batching spreads that wait over all
+    the writes of a batch. Once submit() returns, the write is on disk.
+    """
+    def __init__(self, path='kokobot.db', readers=2, cached_statements=256, pragmas=None,
+                 batch_size=64, batch_delay=0.005):
+        self.path = path
+        self.readers = readers
+        self.cached_statements = cached_statements
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.queue = None
+        self.batch_task = None
+        self.pragmas = {
+            'synchronous': 'FULL',  # sync the WAL on every commit, so committed writes survive power loss
+            'cache_size': -16 * 1024,  # KiB per connection
+            'mmap_size': 256 * 1024 * 1024,  # bytes
+            'busy_timeout': 5000,  # ms
+            'foreign_keys': 'ON',
+        }
+        if not pragmas is None:
+            self.pragmas.update(pragmas)
+        self.local = threading.local()
+        self.write_executor = None
+        self.read_executor = None
+        self.open_lock = None
+        self.close_hooks = []
+
+    def __str__(self):
+        return 'kokobot.Storage({})'.format(self.path)
+
+    @property
+    def is_open(self):
+        return not self.write_executor is None
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, cached_statements=self.cached_statements)
+        for pragma, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {pragma}={value}')
+        self.local.conn = conn
+        return conn
+
+    def close_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if not conn is None:
+            conn.close()
+            self.local.conn = None
+
+    async def open(self):
+        if self.open_lock is None:
+            self.open_lock = asyncio.Lock()
+        # Cogs open the storage at the same time, the others wait for the first
+        async with self.open_lock:
+            if self.is_open:
+                return
+            logger.info('Opening {}...'.format(self))
+            write_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='kokobot-db-writer')
+            read_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.readers, thread_name_prefix='kokobot-db-reader')
+            # Create the writer connection (and the database file) before any reads
+            loop = asyncio.get_event_loop()
+            mode = await loop.run_in_executor(write_executor, self.call,
+                                              lambda conn: conn.execute('PRAGMA journal_mode=WAL').fetchone()[0])
+            logger.info('Using {} journal mode'.format(mode))
+
+            # Only look open once submit() can queue writes
+            self.queue = asyncio.Queue()
+            self.read_executor = read_executor
+            self.write_executor = write_executor
+            self.batch_task = asyncio.ensure_future(self.batch_writes())
+
+    def add_close_hook(self, hook):
+        """Have hook() awaited when the storage closes, while it can still write.
+
+        For cogs to write out what they only keep in memory.
+        """
+        self.close_hooks.append(hook)
+
+    async def close(self):
+        if not self.is_open:
+            return
+        logger.info('Closing {}...'.format(self))
+        for hook in self.close_hooks:
+            try:
+                await hook()
+            except Exception:
+                logger.exception('Error in close hook {}'.format(hook))
+        # Commit the writes that are still queued up
+        await self.queue.put(None)
+        await self.batch_task
+        self.queue = None
+        self.batch_task = None
+
+        write_executor, read_executor = self.write_executor, self.read_executor
+        self.write_executor = None
+        self.read_executor = None
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(write_executor, self.close_connection)
+        # Reader connections are closed along with their threads
+        await loop.run_in_executor(None, read_executor.shutdown)
+        write_executor.shutdown(wait=False)
+
+    def call(self, fn, *args):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.connect()
+        return fn(conn, *args)
+
+    async def run(self, executor, fn, *args):
+        if executor is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        loop = asyncio.get_event_loop()
+        # Includes the time waiting for a connection to be free
+        with query_seconds.time(executor='write' if executor is self.write_executor else 'read'):
+            return await loop.run_in_executor(executor, self.call, fn, *args)
+
+    async def read(self, fn, *args):
+        """Run fn(conn, *args) on a reader connection."""
+        return await self.run(self.read_executor, fn, *args)
+
+    async def write(self, fn, *args):
+        """Run fn(conn, *args) on the writer connection inside one transaction."""
+        def transaction(conn, *args):
+            with conn:
+                return fn(conn, *args)
+        return await self.run(self.write_executor, transaction, *args)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        """Execute a write statement, commit it and return the row count."""
+        return await self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.write(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def submit(self, sql, params=()):
+        """Queue a write statement and return its row count once it's committed.
+
+        The statement is committed in one transaction with the other queued
+        writes, but it fails on its own if it raises a database error.
+        """
+        if self.queue is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((sql, params, future))
+        return await future
+
+    async def batch_writes(self):
+        while True:
+            write = await self.queue.get()
+            if write is None:
+                return
+            batch = [write]
+            # Wait a bit for other writes to commit with
+            await asyncio.sleep(self.batch_delay)
+            stop = False
+            while len(batch) < self.batch_size and not self.queue.empty():
+                write = self.queue.get_nowait()
+                if write is None:
+                    stop = True
+                    break
+                batch.append(write)
+
+            try:
+                results = await self.run(self.write_executor, run_batch,
+                                         [(sql, params) for sql, params, future in batch])
+            except Exception as e:
+                logger.info('Database error while committing {} writes: {}'.format(len(batch), e))
+                results = [e] * len(batch)
+            for (sql, params, future), result in zip(batch, results):
+                if future.cancelled():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            if stop:
+                return
+
+    async def data_version(self):
+        """Get a number that changes whenever another process commits to the database.
+
+        Commits made through this storage don't change it, so comparing it
+        between calls tells whether data cached in memory may be stale.
+        """
+        return await self.run(self.write_executor,
+                              lambda conn: conn.execute('PRAGMA data_version').fetchone()[0])
+
+    async def executescript(self, script):
+        return await self.run(self.write_executor, lambda conn: conn.executescript(script).close())
+
+    async def migrate(self, component, migrations):
+        """Apply the migrations of a component that haven't been applied yet.
+
+        migrations is a list of (version, description, migration), where
+        migration is either a list of SQL statements or a function that takes
+        the writer connection. Each migration runs in its own transaction and
+        is recorded in the migrations table, so it's only ever applied once.
+        """
+        def run(conn):
+            conn.execute('''CREATE TABLE IF NOT EXISTS migrations (
+                component TEXT,
+                version INT,
+                description TEXT,
+                date INT,
+                PRIMARY KEY (component, version)
+            )''')
+            conn.commit()
+            applied = set(row[0] for row in conn.execute(
+                'SELECT version FROM migrations WHERE component=(?)', (component,)))
+            done = []
+            for version, description, migration in sorted(migrations, key=lambda m: m[0]):
+                if version in applied:
+                    continue
+                # Take the write lock first, another process may be migrating too
+                conn.execute('BEGIN IMMEDIATE')
+                if not conn.execute('SELECT 1 FROM migrations WHERE component=(?) AND version=(?)',
+                                    (component, version)).fetchone() is None:
+                    conn.rollback()
+                    continue
+                try:
+                    if callable(migration):
+                        migration(conn)
+                    else:
+                        for statement in migration:
+                            conn.execute(statement)
+                    conn.execute("INSERT INTO migrations VALUES (?, ?, ?, CAST(strftime('%s', 'now') AS INT))",
+                                 (component, version, description))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                done.append((version, description))
+            return done
+
+        done = await self.run(self.write_executor, run)
+        for version, description in done:
+            logger.info('Applied {} migration {}: {}'.format(component, version, description))
+        return done
+
+
+def run_batch(conn, batch):
+    """Execute a batch of (sql, params) in one transaction, each in its own savepoint.
+
+    Returns the row count of each statement, or the error it raised.
+    """
+    results = []
+    conn.execute('BEGIN')
+    try:
+        for sql, params in batch:
+            conn.execute('SAVEPOINT write')
+            try:
+                results.append(conn.execute(sql, params).rowcount)
+            except sqlite3.Error as e:
+                conn.execute('ROLLBACK TO write')
+                results.append(e)
+            conn.execute('RELEASE write')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return results
+
+
+def get_storage(bot, path='kokobot.db'):
+    """Get the storage shared by every cog of this bot, creating it if needed."""
+    if getattr(bot, 'storage', None) is None:
+        bot.storage = Storage(path)
+    return bot.storage